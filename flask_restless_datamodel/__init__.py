@@ -1,9 +1,14 @@
-__all__ = ("__version__", "DataModel")
-
-from pbr.version import VersionInfo
+__all__ = ("__version__", "DataModel", "cache_result", "run_as_job")
 
 from . import patches  # noqa
+from .cache import cache_result  # noqa
 from .datamodel import DataModel  # noqa
+from .helpers import server_version
+from .jobs import run_as_job  # noqa
+
 
-# Check the PBR version module docs for other options than release_string()
-__version__ = VersionInfo("flask-restless-datamodel").release_string()
+def __getattr__(name):
+    # the version is only looked up when asked for
+    if name == "__version__":
+        return server_version()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
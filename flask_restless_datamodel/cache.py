@@ -0,0 +1,160 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+CACHE_MARKER = "_datamodel_cache_ttl"
+
+
+def cache_result(fn=None, ttl=None):
+    """
+    Mark an exposed method or property getter as cacheable, for properties
+    it goes beneath `@property`. Results are cached per instance and
+    arguments for `ttl` seconds, or the `result_cache_ttl` of the datamodel.
+    """
+
+    def mark(fn):
+        setattr(fn, CACHE_MARKER, ttl)
+        return fn
+
+    if fn is None:
+        return mark
+    return mark(fn)
+
+
+def cache_ttl(attribute, default):
+    """
+    The ttl to cache the results of a method or property with, None when it
+    isn't marked as cacheable.
+    """
+    if isinstance(attribute, property):
+        attribute = attribute.fget
+    attribute = getattr(attribute, "__func__", attribute)
+    if not hasattr(attribute, CACHE_MARKER):
+        return None
+    ttl = getattr(attribute, CACHE_MARKER)
+    return default if ttl is None else ttl
+
+
+class RenderCache:
+    """
+    On-disk cache of model renders. Every render is stored together with the
+    fingerprint of the model it was made for, and is only handed out again
+    for a model with that same fingerprint. The whole file is discarded when
+    it was written for different datamodel metadata, e.g. by another version
+    of this library. `meta` is called for that metadata once the file is read.
+    """
+
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.dirty = False
+        self._renders = None
+
+    @property
+    def renders(self):
+        if self._renders is None:
+            self._renders = {}
+            try:
+                with open(self.path) as fh:
+                    content = json.load(fh)
+            except (OSError, ValueError):
+                content = {}
+            if content.get("meta") == self.meta():
+                self._renders = content.get("models", {})
+        return self._renders
+
+    def get(self, name, fingerprint):
+        entry = self.renders.get(name)
+        if entry and entry["fingerprint"] == fingerprint:
+            return entry["render"]
+        return None
+
+    def set(self, name, fingerprint, render):
+        self.renders[name] = {"fingerprint": fingerprint, "render": render}
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        content = {"meta": self.meta(), "models": self.renders}
+        # write to a temporary file first, so concurrently booting processes
+        # never read a half written cache
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump(content, fh)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.dirty = False
+
+
+class ResultCache:
+    """
+    Bounded LRU cache of serialized RPC results, keyed by `(model, instid,
+    name, payload)`. Entries expire after their ttl, and all entries of an
+    instance are dropped when it is invalidated.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.instance_keys = defaultdict(set)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, payload, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, payload)
+            self.entries.move_to_end(key)
+            self.instance_keys[key[:2]].add(key)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, model, instid):
+        with self.lock:
+            for key in self.instance_keys.pop((model, str(instid)), ()):
+                del self.entries[key]
+                self.invalidations += 1
+
+    def _remove(self, key):
+        del self.entries[key]
+        keys = self.instance_keys[key[:2]]
+        keys.discard(key)
+        if not keys:
+            del self.instance_keys[key[:2]]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
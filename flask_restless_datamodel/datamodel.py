@@ -1,15 +1,30 @@
+import hashlib
 import json
+import threading
 from collections import defaultdict
 from functools import wraps
 
 import flask_restless
 from cereal_lazer import Cereal
-from flask import Response, abort
+from flask import abort, request
 from flask.blueprints import Blueprint
 from flask.testing import EnvironBuilder
-from pbr.version import VersionInfo
 
-from .helpers import ModelConfiguration
+from .cache import RenderCache, ResultCache
+from .helpers import (
+    META_KEY,
+    ModelConfiguration,
+    RPCDispatcher,
+    RPCRules,
+    abort as abort_with_message,
+    build_payload,
+    payload_response,
+    server_version,
+    streamed_payload_response,
+)
+from .jobs import JobQueue, job_status
+from .jsonbackend import get_json_backend
+from .patches import prime_is_like_list
 from .render import DataModelRenderer
 
 
@@ -29,9 +44,16 @@ def catch_model_view(dispatch_request, getaway_car):
     becomes dirty and restrictive.
 
     And this way, we're at least dropping the restrictive part :)
+
+    The view class is shared by all models, so only calls from the capturing
+    thread are caught. Requests served meanwhile on other threads, e.g. while
+    rendering lazily, go to the original method.
     """
+    capturing_thread = threading.get_ident()
 
     def wrapper(self, *args, **kwargs):
+        if threading.get_ident() != capturing_thread:
+            return dispatch_request(self, *args, **kwargs)
         # Putting back the old and original dispatch_request method to continue
         # normal operation from this point on.
         self.__class__.dispatch_request = dispatch_request
@@ -50,16 +72,28 @@ def attach_listener(create_blueprint, data_model):
             kwargs["preprocessors"] = data_model.processors
             return create_blueprint(model, *args, **kwargs)
         blueprint = create_blueprint(model, *args, **kwargs)
+        if data_model.app is None:
+            # the datamodel itself isn't registered yet, it will pick up this
+            # model together with all others once it is.
+            return blueprint
+        api_info = data_model.api_manager.created_apis_for[model]
+        if data_model.render_lazily:
+            # the view is only captured when finalizing the datamodel, by then
+            # flask-restless will have registered the blueprint itself.
+            data_model.register_model(model, api_info, app)
+            return blueprint
         blueprint_name = f"{blueprint.name}.canary"
         # this register is needed to capture the view in get_restless_view
         app.register_blueprint(blueprint, name=blueprint_name)
-        api_info = data_model.api_manager.created_apis_for[model]
         data_model.register_model(model, api_info, app, bp_name=blueprint_name)
         return blueprint
 
     return wrapper
 
 
+MAX_CACHED_SELECTIONS = 128
+
+
 class DataModel(object):
     __tablename__ = "flask-restless-datamodel"
 
@@ -82,17 +116,40 @@ class DataModel(object):
             "flask-restless-datamodel-rpc",
             url_prefix=options.get("api_prefix", "/api"),
         )
-        vi = VersionInfo("flask-restless-datamodel")
         serialize_naively = options.get("serialize_naively", False)
         self.data_model = {
-            "FlaskRestlessDatamodel": {
-                "server_version": vi.release_string(),
+            META_KEY: {
+                # filled in by `meta`, reading the package metadata is slow
+                "server_version": None,
                 "serialize_naively": serialize_naively,
             }
         }
         self.polymorphic_info = defaultdict(dict)
         self.options = options
+        self._serialized = None
+        self._serialized_selections = {}
+        self._fragments = {}
+        self.stream_datamodel = options.get("stream_datamodel", False)
+        self.json_backend = get_json_backend(options.get("json_backend"))
         self.model_renderer = None
+        self.render_lazily = options.get("render_lazily", False)
+        self.pending_models = []
+        # held while rendering deferred models, so requests wait for all of them
+        self.finalize_lock = threading.Lock()
+        self.render_cache = None
+        self.rpc_rules = None
+        self.rpc_dispatcher = None
+        # the RPC rules added for each model, by model name
+        self.model_rules = {}
+        if options.get("rpc_dispatcher", False):
+            self.rpc_dispatcher = RPCDispatcher()
+        self.jobs = JobQueue(
+            max_workers=options.get("job_workers", 4),
+            max_jobs=options.get("max_jobs", 100),
+        )
+        self.result_cache = ResultCache(options.get("result_cache_size", 1024))
+        if options.get("cache_file"):
+            self.render_cache = RenderCache(options["cache_file"], self.meta)
 
         self.model_views = {}
         self.app = None
@@ -107,26 +164,87 @@ class DataModel(object):
         if not hasattr(app, "extensions"):
             app.extensions = {}
         app.extensions["cereal"] = self.cereal
+        app.extensions["datamodel_json"] = self.json_backend
+        app.extensions["datamodel_jobs"] = self.jobs
+        app.extensions["datamodel_results"] = self.result_cache
 
         self.model_renderer = DataModelRenderer(app, db, self.options)
+        self.rpc_rules = RPCRules(app, self.rpc_blueprint)
         # render datamodel for models that were already registered to
         # flask-restless
-        for model, api_info in self.api_manager.created_apis_for.items():
-            self.register_model(model, api_info, app)
+        apis = [
+            (model, api_info, api_info.blueprint_name)
+            for model, api_info in self.api_manager.created_apis_for.items()
+        ]
+        self.register_models(apis, app)
 
     def register_model(self, model, api_info, app, bp_name=None):
-        name = model.__name__
         blueprint_name = api_info.blueprint_name
         if bp_name is not None:
             blueprint_name = bp_name
-        blueprint = app.blueprints[blueprint_name]
-        collection_name = api_info.collection_name
+        self.register_models([(model, api_info, blueprint_name)], app)
 
-        view = self.get_restless_view(model, app, blueprint_name, collection_name)
+    def register_models(self, apis, app):
+        """
+        Register a batch of `(model, api_info, blueprint_name)` entries. The
+        flask-restless views of the whole batch are captured in a single stub
+        request, instead of building a request for every model.
 
-        conf = ModelConfiguration(collection_name, view, blueprint, self.rpc_blueprint)
-        render = self.model_renderer.render(model, conf)
+        When rendering lazily, the entries are only recorded here and get
+        rendered by `finalize`. Otherwise new renders are written to the
+        `cache_file` straight away.
+        """
+        if self.render_lazily:
+            with self.finalize_lock:
+                self.pending_models.extend(apis)
+            return
+        self.render_models(apis, app)
+        if self.render_cache is not None:
+            self.render_cache.save()
+
+    def finalize(self):
+        """
+        Render the models whose registration was deferred by `render_lazily`
+        and write new renders to the `cache_file`, if any. This happens on the
+        first datamodel request, but can be called explicitly as well, e.g. to
+        have the RPC endpoints available before that. Concurrent callers wait
+        until the models are rendered.
+        """
+        with self.finalize_lock:
+            apis, self.pending_models = self.pending_models, []
+            if apis:
+                self.render_models(apis, self.app)
+            if self.render_cache is not None:
+                self.render_cache.save()
+
+    def render_models(self, apis, app):
+        views = self.get_restless_views(
+            app, [(bp_name, api_info.collection_name) for _, api_info, bp_name in apis]
+        )
+        for (model, api_info, blueprint_name), view in zip(apis, views):
+            self.render_model(model, api_info, app, blueprint_name, view)
+
+    def render_model(self, model, api_info, app, blueprint_name, view):
+        name = model.__name__
+        blueprint = app.blueprints[blueprint_name]
+        collection_name = api_info.collection_name
 
+        rpc_blueprint = self.rpc_rules
+        if self.rpc_dispatcher is not None:
+            rpc_blueprint = self.rpc_dispatcher
+        conf = ModelConfiguration(collection_name, view, blueprint, rpc_blueprint)
+        rpc_blueprint.take_added()
+        render = self.render_model_definition(model, conf)
+        prime_is_like_list(model)
+
+        # properties and methods that are no longer exposed lose their rules
+        added = rpc_blueprint.take_added()
+        rpc_blueprint.remove_url_rules(self.model_rules.get(name, set()) - added)
+        self.model_rules[name] = added
+
+        changed = {name}
+        if name in self.data_model:
+            changed.update(self.forget_polymorphic_identities(name))
         polymorphic_info = self.model_renderer.render_polymorphic(
             model, self.polymorphic_info[name]
         )
@@ -135,17 +253,183 @@ class DataModel(object):
             parent = polymorphic_info["parent"]
             identity = polymorphic_info["identity"]
             self.polymorphic_info[parent][identity] = name
+            changed.add(parent)
 
         if polymorphic_info:
             render["polymorphic"] = polymorphic_info
 
         self.data_model[name] = render
+        self.invalidate_serialized(changed)
+
+    def rerender_model(self, model, bp_name=None):
+        """
+        Render a single, already registered, model again, e.g. after its
+        flask-restless view or the model itself changed. Only the cached JSON
+        of this model, and of the polymorphic parents it (no longer) is an
+        identity of, is invalidated.
+        """
+        api_info = self.api_manager.created_apis_for[model]
+        self.register_model(model, api_info, self.app, bp_name)
+
+    def forget_polymorphic_identities(self, name):
+        """
+        Drop the polymorphic identities that point to a model, as it may have
+        a different identity or parent after rendering it again. Returns the
+        parents that had one.
+        """
+        parents = set()
+        for parent, identities in self.polymorphic_info.items():
+            stale = [key for key, child in identities.items() if child == name]
+            for key in stale:
+                del identities[key]
+                parents.add(parent)
+        return parents
+
+    def invalidate_serialized(self, names):
+        """Drop the cached payloads that include any of the given models."""
+        for name in names:
+            self._fragments.pop(name, None)
+        self._serialized = None
+        stale = [key for key in self._serialized_selections if names.intersection(key)]
+        for key in stale:
+            del self._serialized_selections[key]
+
+    def render_model_definition(self, model, conf):
+        if self.render_cache is None:
+            return self.model_renderer.render(model, conf)
+
+        # the polymorphic info depends on other models, so it isn't cached
+        name = model.__name__
+        fingerprint = self.model_renderer.fingerprint(model, conf)
+        render = self.render_cache.get(name, fingerprint)
+        if render is not None:
+            self.model_renderer.restore(model, conf, render)
+            return {k: v for k, v in render.items() if k != "polymorphic"}
+        render = self.model_renderer.render(model, conf)
+        self.render_cache.set(name, fingerprint, dict(render))
+        return render
 
     def register_rpc_blueprint(self):
         # this register is needed to register the addtional endpoints we create
         # should look into making a different blueprint for this.
+        if self.rpc_dispatcher is not None:
+            self.rpc_dispatcher.register(self.rpc_blueprint)
+        self.rpc_blueprint.add_url_rule("/job/<job_id>", view_func=job_status)
         self.app.register_blueprint(self.rpc_blueprint)
 
+    @property
+    def serialized_data_model(self):
+        """
+        The datamodel serialized to JSON bytes, together with its content hash.
+        It is only serialized again after a model (re)registration changed it.
+        """
+        self.finalize()
+        if self._serialized is None:
+            body = b"".join(self.iter_serialized(self.data_model))
+            self._serialized = build_payload(body)
+        return self._serialized
+
+    def meta(self):
+        """The metadata entry of the datamodel, with the server version."""
+        meta = self.data_model[META_KEY]
+        if meta["server_version"] is None:
+            meta["server_version"] = server_version()
+        return meta
+
+    def model_fragment(self, name):
+        """
+        The JSON of a single entry of the datamodel, with its hash. Fragments
+        are kept until the model they belong to changes.
+        """
+        if name not in self._fragments:
+            if name == META_KEY:
+                self.meta()
+            fragment = self.json_backend.dumps(self.data_model[name])
+            self._fragments[name] = (fragment, hashlib.sha1(fragment).hexdigest())
+        return self._fragments[name]
+
+    def iter_serialized(self, names):
+        """
+        Yield the JSON of the datamodel restricted to the given entries, one
+        entry at a time.
+        """
+        separator = b"{"
+        for name in list(names):
+            fragment, _ = self.model_fragment(name)
+            key = self.json_backend.dumps(name)
+            yield separator + key + b": " + fragment
+            separator = b", "
+        yield b"{}" if separator == b"{" else b"}"
+
+    def streamed_response(self, names):
+        names = list(names)
+        digests = [[name, self.model_fragment(name)[1]] for name in names]
+        etag = hashlib.sha1(json.dumps(digests).encode("utf-8")).hexdigest()
+        return streamed_payload_response(self.iter_serialized(names), etag)
+
+    def serialized_selection(self, names, closure=False):
+        """
+        Like `serialized_data_model`, but only for the given models and, with
+        `closure`, every model they relate to or inherit from, transitively.
+        Every distinct selection is serialized once.
+        """
+        self.finalize()
+        names = self.selected_names(names, closure)
+        if names not in self._serialized_selections:
+            if len(self._serialized_selections) >= MAX_CACHED_SELECTIONS:
+                # evict the oldest selection
+                del self._serialized_selections[next(iter(self._serialized_selections))]
+            body = b"".join(self.iter_serialized(names))
+            self._serialized_selections[names] = build_payload(body)
+        return self._serialized_selections[names]
+
+    def selected_names(self, names, closure=False):
+        names = frozenset(names)
+        if closure:
+            names = self.dependency_closure(names)
+        return (META_KEY,) + tuple(sorted(names))
+
+    def dependency_closure(self, names):
+        closure = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            # related models without a flask-restless api aren't in the datamodel
+            if name in closure or name not in self.data_model:
+                continue
+            closure.add(name)
+            render = self.data_model[name]
+            pending.extend(rel["foreign_model"] for rel in render["relations"].values())
+            polymorphic = render.get("polymorphic", {})
+            if "parent" in polymorphic:
+                pending.append(polymorphic["parent"])
+            pending.extend(polymorphic.get("identities", {}).values())
+        return frozenset(closure)
+
+    def requested_models(self, args):
+        """
+        Resolve the models requested with the `models` (model names) and
+        `collections` (collection names) query arguments, as a list of model
+        names. Returns None when no selection was made.
+        """
+        models = [m for arg in args.getlist("models") for m in arg.split(",") if m]
+        collections = [
+            c for arg in args.getlist("collections") for c in arg.split(",") if c
+        ]
+        if not models and not collections:
+            return None
+
+        by_collection = {
+            render["collection_name"]: name
+            for name, render in self.data_model.items()
+            if name != META_KEY
+        }
+        unknown = [m for m in models if m == META_KEY or m not in self.data_model]
+        unknown.extend(c for c in collections if c not in by_collection)
+        if unknown:
+            abort_with_message("Unknown models: {}".format(", ".join(unknown)), 400)
+        return models + [by_collection[c] for c in collections]
+
     @property
     def processors(self):
         return {
@@ -167,12 +451,29 @@ class DataModel(object):
         actual db queries are executed on it. This is why we're (mis)using the
         flask abort to prematurely break off the normal restless flow,
         as by now we have all the data we need to return our request.
+
+        The response carries the hash of the payload as ETag, a request with a
+        matching If-None-Match header is answered with a 304.
+
+        A subset of the datamodel can be requested with the `models` and
+        `collections` query arguments, adding `closure=1` includes all models
+        the requested ones depend on. With `stream_datamodel`, the response is
+        streamed model by model from the cached fragments instead.
         """
+        self.finalize()
+        names = self.requested_models(request.args)
+        closure = request.args.get("closure", "0").lower() in ("1", "true")
+        if self.stream_datamodel:
+            if names is not None:
+                names = self.selected_names(names, closure)
+            response = self.streamed_response(names or self.data_model)
+        elif names is None:
+            response = payload_response(self.serialized_data_model)
+        else:
+            response = payload_response(self.serialized_selection(names, closure))
         # (Mis)using the flask abort to return the datamodel before the
         # request gets forwarded to the actual db querying
-        abort(
-            Response(response=json.dumps(self.data_model), mimetype="application/json")
-        )
+        abort(response)
 
     def get_restless_view(self, model, app, blueprint_name, collection_name):
         """
@@ -184,22 +485,30 @@ class DataModel(object):
         After the first call it will replace the function handle back to its
         original function.
         """
-        api_format = flask_restless.APIManager.APINAME_FORMAT
-        endpoint = api_format.format(f"{blueprint_name}.{collection_name}")
-
-        view_func = app.view_functions[endpoint]
+        return self.get_restless_views(app, [(blueprint_name, collection_name)])[0]
 
+    def get_restless_views(self, app, endpoints):
+        """
+        Capture the views of several `(blueprint_name, collection_name)`
+        endpoints, see `get_restless_view`. All views are dispatched within the
+        same stub request context.
+        """
+        api_format = flask_restless.APIManager.APINAME_FORMAT
         getaway_car = []
-        dispatch_fn = catch_model_view(
-            view_func.view_class.dispatch_request, getaway_car
-        )
-        view_func.view_class.dispatch_request = dispatch_fn
+        if not endpoints:
+            return getaway_car
 
         with app.request_context(self.build_stub_environ(app)):
-            view_func().json
-
-        view: flask_restless.views.API = getaway_car[0]
-        return view
+            for blueprint_name, collection_name in endpoints:
+                endpoint = api_format.format(f"{blueprint_name}.{collection_name}")
+                view_func = app.view_functions[endpoint]
+                dispatch_fn = catch_model_view(
+                    view_func.view_class.dispatch_request, getaway_car
+                )
+                view_func.view_class.dispatch_request = dispatch_fn
+                view_func().json
+
+        return getaway_car
 
     def build_stub_environ(self, app):
         kw = {"base_url": "http://localhost"}
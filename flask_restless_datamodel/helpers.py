@@ -1,17 +1,175 @@
-import json
-from collections import namedtuple
+import functools
+import gzip
+import hashlib
+from collections import defaultdict, namedtuple
+from collections.abc import Iterable
+from itertools import islice
 
 import flask
+import msgpack
+from cereal_lazer.cereal import INSTANCE_KEY
+from flask_restless.helpers import primary_key_name
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.inspection import inspect as sqla_inspect
+from sqlalchemy.orm.query import Query
 from sqlalchemy.orm.session import Session
 
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+META_KEY = "FlaskRestlessDatamodel"
+# RPC payloads sent or accepted as raw cereal bytes instead of a JSON envelope
+CEREAL_MIMETYPE = "application/vnd.cereal+msgpack"
+# collection results streamed as one JSON envelope per chunk, one per line
+NDJSON_MIMETYPE = "application/x-ndjson"
+DEFAULT_PAGE_SIZE = 1000
+
 ModelConfiguration = namedtuple(
     "ModelConfiguration", "collection_name view blueprint rpc_blueprint"
 )
+SerializedPayload = namedtuple("SerializedPayload", "encodings etag")
+
+
+def add_url_rule(app, rule, endpoint, view_func, **options):
+    """
+    `app.add_url_rule`, also once the app served its first request: models
+    rendered lazily, or again, only add their RPC rules by then.
+    """
+    add = type(app).add_url_rule
+    getattr(add, "__wrapped__", add)(app, rule, endpoint, view_func, **options)
+
+
+class RPCRuleTable:
+    """
+    The view function, methods and defaults the RPC rules were last added
+    with, by rule. Requests are dispatched with a lookup in this table, so
+    rendering a model again, or dropping the rules of properties and methods
+    it no longer exposes, only edits the table.
+    """
+
+    def __init__(self):
+        self.rules = {}
+        # rules added since the last call to `take_added`
+        self.added = set()
+
+    def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
+        methods = options.get("methods", ["GET"])
+        self.rules[rule] = (view_func, methods, options.get("defaults", {}))
+        self.added.add(rule)
+
+    def take_added(self):
+        added, self.added = self.added, set()
+        return added
+
+    def remove_url_rules(self, rules):
+        for rule in rules:
+            self.rules.pop(rule, None)
+        self.added.difference_update(rules)
+
+    def call(self, rule, kwargs):
+        if rule not in self.rules:
+            flask.abort(404)
+        view_func, methods, defaults = self.rules[rule]
+        if flask.request.method not in methods:
+            flask.abort(405)
+        return view_func(**defaults, **kwargs)
+
+
+class RPCRules(RPCRuleTable):
+    """
+    Stand-in for the RPC blueprint that adds every url rule to the url map
+    only once, all pointing at `dispatch`. Rules added after the blueprint got
+    registered go to the app directly, as Flask doesn't forward those.
+    """
+
+    def __init__(self, app, blueprint):
+        super().__init__()
+        self.app = app
+        self.blueprint = blueprint
+        # rules that are in the url map, or will be once the blueprint is
+        self.routed = set()
+
+    def is_registered(self):
+        return self.app.blueprints.get(self.blueprint.name) is self.blueprint
+
+    def full_rule(self, rule):
+        if self.blueprint.url_prefix is None:
+            return rule
+        return "/".join((self.blueprint.url_prefix.rstrip("/"), rule.lstrip("/")))
+
+    def add_url_rule(self, rule, endpoint=None, view_func=None, **options):
+        super().add_url_rule(rule, endpoint, view_func, **options)
+        if rule in self.routed:
+            return
+        self.routed.add(rule)
+        # the methods a rule accepts may change when rendering it again
+        options = {"methods": ["GET", "POST"], "defaults": {"rule": rule}}
+        if self.is_registered():
+            endpoint = f"{self.blueprint.name}.rpc_rule"
+            add_url_rule(
+                self.app, self.full_rule(rule), endpoint, self.dispatch, **options
+            )
+        else:
+            self.blueprint.add_url_rule(rule, "rpc_rule", self.dispatch, **options)
+
+    def dispatch(self, rule, **kwargs):
+        return self.call(rule, kwargs)
 
 
-def abort(msg):
+class RPCDispatcher(RPCRuleTable):
+    """
+    Stand-in for the RPC blueprint that keeps the url rules of the RPC
+    endpoints in a dict instead of adding every one of them to the url map.
+    A handful of parameterized routes then dispatch requests with a single
+    dict lookup, so only the exact rules the renderers added are reachable.
+    """
+
+    ROUTES = (
+        "/method/<collection>/<instid>/<name>",
+        "/method/<collection>/<name>",
+        "/property/<collection>/<instid>/<name>",
+        "/property/<collection>",
+    )
+
+    def __init__(self):
+        super().__init__()
+        self.registered = False
+
+    def register(self, blueprint):
+        if self.registered:
+            return
+        for route in self.ROUTES:
+            blueprint.add_url_rule(
+                route,
+                endpoint="rpc_dispatch",
+                methods=["GET", "POST"],
+                defaults={"route": route},
+                view_func=self.dispatch,
+            )
+        self.registered = True
+
+    def dispatch(self, route, collection, name=None, **kwargs):
+        rule = route.replace("<collection>", collection)
+        if name is not None:
+            rule = rule.replace("<name>", name)
+        return self.call(rule, kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def server_version():
+    # reading the package metadata is slow, so only do it when needed, once
+    from pbr.version import VersionInfo
+
+    # Check the PBR version module docs for other options than release_string()
+    return VersionInfo("flask-restless-datamodel").release_string()
+
+
+def abort(msg, status_code=500):
     resp = flask.jsonify(message=msg)
-    resp.status_code = 500
+    resp.status_code = status_code
     flask.abort(resp)
 
 
@@ -19,11 +177,139 @@ def cr():
     return flask.current_app.extensions["cereal"]
 
 
+def result_cache():
+    return flask.current_app.extensions["datamodel_results"]
+
+
+def json_backend():
+    return flask.current_app.extensions["datamodel_json"]
+
+
+def request_json():
+    try:
+        return json_backend().loads(flask.request.get_data())
+    except ValueError:
+        abort("Malformed JSON body", status_code=400)
+
+
+def request_payload(enveloped=True):
+    """
+    The cereal payload of a request. It is either sent as raw cereal bytes, or
+    as JSON: wrapped in an envelope or, when not `enveloped`, as a string.
+    """
+    if flask.request.mimetype == CEREAL_MIMETYPE:
+        return flask.request.get_data().hex()
+    body = request_json()
+    if enveloped:
+        if not isinstance(body, dict) or "payload" not in body:
+            abort('Expected a JSON object with a "payload"', status_code=400)
+        body = body["payload"]
+    if not isinstance(body, str):
+        abort("Expected the payload as a string", status_code=400)
+    return body
+
+
+def rpc_response(payload, **fields):
+    """
+    Respond with a cereal payload. Clients that accept the cereal mimetype get
+    the raw cereal bytes as body and the extra fields as headers, all others
+    get a JSON envelope.
+    """
+    accepted = flask.request.accept_mimetypes
+    if accepted.best_match(["application/json", CEREAL_MIMETYPE]) != CEREAL_MIMETYPE:
+        return wrap_payload(payload, **fields)
+    response = flask.Response(bytes.fromhex(payload), mimetype=CEREAL_MIMETYPE)
+    for name, value in fields.items():
+        header = "X-Datamodel-{}".format(name.replace("_", "-").title())
+        response.headers[header] = json_backend().dumps(value).decode("utf-8")
+    return response
+
+
+def wrap_payload(payload, **fields):
+    """
+    Wrap a cereal payload in a JSON envelope, together with some extra fields.
+    Cereal payloads are hex strings, so they are inserted as they are instead
+    of being encoded as JSON a second time.
+    """
+    body = b'{"payload": "' + payload.encode("ascii") + b'"'
+    if fields:
+        # strip the opening brace of the encoded fields
+        return body + b", " + json_backend().dumps(fields)[1:]
+    return body + b"}"
+
+
+def build_payload(body):
+    """
+    Keep compressed copies of a JSON body next to it, in order of preference,
+    so responses never need to be compressed per request.
+    """
+    encodings = {}
+    if brotli is not None:
+        encodings["br"] = brotli.compress(body)
+    encodings["gzip"] = gzip.compress(body)
+    encodings["identity"] = body
+    return SerializedPayload(encodings, hashlib.sha1(body).hexdigest())
+
+
+def payload_response(payload):
+    """
+    Build a response for a pre-serialized payload, picking the encoding the
+    client prefers from its Accept-Encoding header. The content hash is sent
+    as a strong ETag, so clients that already hold this exact payload get a
+    304 without a body.
+    """
+    accepted = flask.request.accept_encodings
+    encoding = accepted.best_match(payload.encodings, default="identity")
+    response = flask.Response(
+        response=payload.encodings[encoding], mimetype="application/json"
+    )
+    response.vary.add("Accept-Encoding")
+    etag = payload.etag
+    if encoding != "identity":
+        # a strong etag identifies the exact bytes, so every encoding has its own
+        response.content_encoding = encoding
+        etag = f"{etag}-{encoding}"
+    response.set_etag(etag)
+    return response.make_conditional(flask.request)
+
+
+def streamed_payload_response(chunks, etag):
+    """
+    Stream a JSON body chunk by chunk. Streamed responses aren't compressed,
+    the etag has to be known before the body is produced.
+    """
+    response = flask.Response(response=chunks, mimetype="application/json")
+    response.set_etag(etag)
+    return response.make_conditional(flask.request)
+
+
+def identity_cache():
+    """
+    Request scoped cache of model instances, keyed by `(model, str(pk))`. It
+    is cleared whenever a session commits or rolls back.
+    """
+    if "datamodel_instances" not in flask.g:
+        flask.g.datamodel_instances = {}
+    return flask.g.datamodel_instances
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_soft_rollback")
+def clear_identity_cache(session, *args):
+    if flask.has_app_context():
+        flask.g.pop("datamodel_instances", None)
+
+
 def register_serializer(model, pk_name, serialize, deserialize, cr):
     def load_model(value):
         pkval = value.get(pk_name)
         if pkval:
-            return model.query.filter_by(**{pk_name: pkval}).one_or_none()
+            cache = identity_cache()
+            key = (model, str(pkval))
+            if key not in cache:
+                query = model.query.filter_by(**{pk_name: pkval})
+                cache[key] = query.one_or_none()
+            return cache[key]
         return deserialize(value)
 
     def serialize_model(value):
@@ -32,57 +318,465 @@ def register_serializer(model, pk_name, serialize, deserialize, cr):
     cr.register_class(model.__name__, model, serialize_model, load_model)
 
 
-def run_object_method(instid, function_name, model, commit_on_return):
-    instance = model.query.get(instid)
-    if not instance:
-        return {}
-    params = cr().loads(flask.request.get_json()["payload"])
+def collect_references(value, references):
+    """
+    Collect the serialized form of every instance in a decoded, but not yet
+    deserialized, cereal payload, grouped by the name it was registered as.
+    """
+    if isinstance(value, dict):
+        if INSTANCE_KEY in value:
+            as_name, obj = value[INSTANCE_KEY]
+            references[as_name].append(obj)
+            collect_references(obj, references)
+        else:
+            for item in value.values():
+                collect_references(item, references)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            collect_references(item, references)
+
+
+def decode_payload(content):
+    """
+    Decode the msgpack structure of a cereal payload without deserializing
+    anything in it. None when it isn't valid, the actual deserialization is
+    left to report that.
+    """
     try:
-        result = getattr(instance, function_name)(*params["args"], **params["kwargs"])
-        payload = cr().dumps(result)
-        result = json.dumps({"payload": payload})
-    except Exception as e:
-        msg = f"{e.__class__.__name__}: {str(e)}"
-        abort(msg)
+        return msgpack.unpackb(bytes.fromhex(content), raw=False)
+    except Exception:
+        return None
+
+
+def prefetch_references(decoded):
+    """
+    Load all model instances referenced in a decoded cereal payload with one
+    query per model, so deserializing the payload doesn't query them one by one.
+    """
+    references = defaultdict(list)
+    collect_references(decoded, references)
+
+    for as_name, values in references.items():
+        model = cr().class_from_name.get(as_name)
+        if sqla_inspect(model, raiseerr=False) is None:
+            continue
+        pk_name = primary_key_name(model)
+        pks = [v.get(pk_name) for v in values if isinstance(v, dict)]
+        get_instances(model, [pk for pk in pks if pk])
+
+
+def load_payload(content, decoded=None):
+    if decoded is None:
+        decoded = decode_payload(content)
+    prefetch_references(decoded)
+    return cr().loads(content)
+
+
+def argument_error(binder, args, kwargs):
+    """
+    Check the still encoded arguments of a call against the signature of the
+    method. Returns an error message, or None when they fit.
+    """
+    if not isinstance(args, list) or not isinstance(kwargs, dict):
+        return "TypeError: args should be a list and kwargs a dict"
+    try:
+        binder.bind(*args, **kwargs)
+    except TypeError as e:
+        return error_message(e)
+    return None
+
+
+def check_call(binder, decoded):
+    """
+    Reject a call with a 400 when its arguments don't fit the method, before
+    anything is loaded from the database.
+    """
+    if binder is None:
+        return
+    if not isinstance(decoded, dict):
+        abort("Expected a payload with args and kwargs", status_code=400)
+    error = argument_error(binder, decoded.get("args"), decoded.get("kwargs"))
+    if error:
+        abort(error, status_code=400)
+
+
+def error_message(e):
+    return f"{e.__class__.__name__}: {str(e)}"
+
 
+@event.listens_for(Session, "after_flush")
+def mark_flushed(session, flush_context):
+    session.info["datamodel_flushed"] = True
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def mark_bulk_written(context):
+    context.session.info["datamodel_flushed"] = True
+
+
+@event.listens_for(Session, "after_begin")
+def track_connection(session, transaction, connection):
+    # the info of a connection outlives its checkout, so start from scratch
+    connection.info.pop("datamodel_written", None)
+    session.info.setdefault("datamodel_connections", []).append(connection)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def mark_written(conn, cursor, statement, parameters, context, executemany):
+    # anything but a plain SELECT may write, e.g. `session.execute("UPDATE …")`
+    if statement.lstrip()[:6].upper() != "SELECT":
+        conn.info["datamodel_written"] = True
+
+
+@event.listens_for(Session, "after_commit")
+@event.listens_for(Session, "after_rollback")
+def clear_flushed(session):
+    session.info.pop("datamodel_flushed", None)
+    session.info.pop("datamodel_connections", None)
+
+
+def has_changes(session):
+    """
+    Whether ending the transaction of a session makes any difference: it has
+    pending changes, flushed or ran bulk writes earlier on, or ran any other
+    statement than a SELECT. Objects in `session.dirty` only count when they
+    have net changes.
+    """
+    if session.new or session.deleted or session.info.get("datamodel_flushed"):
+        return True
+    connections = session.info.get("datamodel_connections", ())
+    if any(connection.info.get("datamodel_written") for connection in connections):
+        return True
+    return any(session.is_modified(instance) for instance in session.dirty)
+
+
+def end_transaction(session, commit_on_return):
+    """
+    Commit or roll back the changes of a call. Returns whether they were
+    committed; a failed commit is rolled back.
+    """
+    # read-only calls don't need a round trip to commit or roll back
+    if not has_changes(session):
+        return commit_on_return
     if commit_on_return:
         try:
-            session = Session.object_session(instance)
             session.commit()
+            return True
         except Exception:
-            pass
+            session.rollback()
+            return False
+    session.rollback()
+    return False
+
+
+def get_instance(model, instid):
+    cache = identity_cache()
+    key = (model, str(instid))
+    if key not in cache:
+        cache[key] = model.query.get(instid)
+    return cache[key]
+
+
+def get_instances(model, instids):
+    """
+    Load the instances of a model for a list of ids, the ones that aren't in
+    the identity cache yet are loaded in a single query. The result is keyed by
+    the string value of the id, as ids coming from urls are strings too.
+    Instances that don't exist are left out.
+    """
+    cache = identity_cache()
+    missing = {str(instid): instid for instid in instids}
+    missing = {k: v for k, v in missing.items() if (model, k) not in cache}
+    if missing:
+        pk_name = primary_key_name(model)
+        pk_attr = getattr(model, pk_name)
+        for instance in model.query.filter(pk_attr.in_(missing.values())):
+            cache[(model, str(getattr(instance, pk_name)))] = instance
+        for instid in missing:
+            cache.setdefault((model, instid), None)
+
+    instances = {}
+    for instid in instids:
+        instance = cache[(model, str(instid))]
+        if instance is not None:
+            instances[str(instid)] = instance
+    return instances
+
+
+def is_collection(value):
+    return isinstance(value, Query) or (
+        isinstance(value, Iterable) and not isinstance(value, (str, bytes, dict))
+    )
+
+
+def pagination_args():
+    """
+    The `page_size` and `cursor` query arguments of a method call, the page
+    size is None when the client didn't ask for pages.
+    """
+    page_size = flask.request.args.get("page_size")
+    cursor = flask.request.args.get("cursor", "0")
+    try:
+        page_size = None if page_size is None else int(page_size)
+        cursor = int(cursor)
+    except ValueError:
+        abort("page_size and cursor should be integers", status_code=400)
+    if (page_size is not None and page_size < 1) or cursor < 0:
+        abort("page_size should be positive and cursor not negative", status_code=400)
+    return page_size, cursor
+
+
+def result_page(result, cursor, page_size):
+    """
+    Take the page of a collection result that starts at offset `cursor`.
+    Queries only load the page itself, other iterables are consumed up to its
+    end. Returns the page and the cursor of the next one, None on the last.
+    """
+    if isinstance(result, Query):
+        items = result.offset(cursor).limit(page_size + 1).all()
     else:
-        session = Session.object_session(instance)
-        session.rollback()
+        items = list(islice(result, cursor, cursor + page_size + 1))
+    if len(items) > page_size:
+        return items[:page_size], cursor + page_size
+    return items, None
+
+
+def result_chunks(result, page_size):
+    if isinstance(result, Query):
+        result = result.yield_per(page_size)
+    iterator = iter(result)
+    chunk = list(islice(iterator, page_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, page_size))
 
+
+def streamed_rpc_response(result, page_size, session, commit_on_return):
+    """
+    Stream a collection result as newline delimited JSON envelopes of at most
+    `page_size` items each. The transaction ends once the whole result is
+    sent; an error halfway is reported on the last line and rolls it back.
+    """
+
+    def lines():
+        failed = False
+        try:
+            for chunk in result_chunks(result, page_size):
+                yield wrap_payload(cr().dumps(chunk)) + b"\n"
+        except Exception as e:
+            failed = True
+            yield json_backend().dumps({"error": error_message(e)}) + b"\n"
+        end_transaction(session, commit_on_return and not failed)
+
+    return flask.Response(flask.stream_with_context(lines()), mimetype=NDJSON_MIMETYPE)
+
+
+def run_object_method(
+    instid, function_name, model, commit_on_return, cache_ttl=None, binder=None
+):
+    """
+    Call a method on an instance. Collection results (lists, iterators and
+    queries) can be fetched in pages by passing `page_size` and `cursor`
+    query arguments, or streamed in chunks to clients accepting NDJSON.
+    Whole results of cacheable methods are served from the result cache.
+    """
+    content = request_payload()
+    page_size, cursor = pagination_args()
+    accepted = flask.request.accept_mimetypes
+    stream = accepted.best_match(["application/json", NDJSON_MIMETYPE])
+    cache_key = None
+    if cache_ttl is not None and page_size is None and stream != NDJSON_MIMETYPE:
+        cache_key = (model, str(instid), function_name, content)
+        payload = result_cache().get(cache_key)
+        if payload is not None:
+            return rpc_response(payload)
+
+    decoded = decode_payload(content)
+    check_call(binder, decoded)
+    instance = get_instance(model, instid)
+    if not instance:
+        return {}
+    params = load_payload(content, decoded)
+    session = Session.object_session(instance)
+    try:
+        result = getattr(instance, function_name)(*params["args"], **params["kwargs"])
+        if stream == NDJSON_MIMETYPE and is_collection(result):
+            page_size = page_size or DEFAULT_PAGE_SIZE
+            if commit_on_return:
+                result_cache().invalidate(model, instid)
+            return streamed_rpc_response(result, page_size, session, commit_on_return)
+        if page_size is not None and is_collection(result):
+            result, next_cursor = result_page(result, cursor, page_size)
+            result = rpc_response(cr().dumps(result), next_cursor=next_cursor)
+        else:
+            payload = cr().dumps(result)
+            result = rpc_response(payload)
+    except Exception as e:
+        abort(error_message(e))
+
+    end_transaction(session, commit_on_return)
+    if commit_on_return:
+        result_cache().invalidate(model, instid)
+    if cache_key is not None:
+        result_cache().set(cache_key, payload, cache_ttl)
     return result
 
 
-def object_property(instid, model, property_name):
+def run_batch_object_method(function_name, model, commit_on_return, binder=None):
+    """
+    Call a method on many instances in one request. The payload is a list of
+    `(instid, args, kwargs)` calls, all instances are loaded in one query and
+    the calls share a single transaction. It is only committed when no call
+    failed, the result of every call is reported separately.
+    """
+    content = request_payload()
+    decoded = decode_payload(content)
+    if not isinstance(decoded, list):
+        abort("Expected a list of [instid, args, kwargs] calls", status_code=400)
+    errors = {}
+    for index, call in enumerate(decoded):
+        if not isinstance(call, list) or len(call) != 3:
+            errors[index] = "TypeError: expected an [instid, args, kwargs] call"
+        elif binder is not None:
+            errors[index] = argument_error(binder, call[1], call[2])
+    calls = load_payload(content, decoded)
+    instids = [call[0] for index, call in enumerate(calls) if not errors.get(index)]
+    instances = get_instances(model, instids)
+
+    results = []
+    failed = False
+    for index, call in enumerate(calls):
+        if errors.get(index):
+            results.append({"error": errors[index]})
+            failed = True
+            continue
+        instid, args, kwargs = call
+        instance = instances.get(str(instid))
+        if instance is None:
+            results.append({"error": f"NotFound: no instance with id {instid}"})
+            failed = True
+            continue
+        try:
+            result = getattr(instance, function_name)(*args, **kwargs)
+            results.append({"result": result})
+        except Exception as e:
+            results.append({"error": error_message(e)})
+            failed = True
+
+    try:
+        payload = cr().dumps(results)
+    except Exception as e:
+        abort(error_message(e))
+
+    committed = end_transaction(model.query.session, commit_on_return and not failed)
+    if committed:
+        for instid in instances:
+            result_cache().invalidate(model, instid)
+    return rpc_response(payload, committed=committed)
+
+
+def object_property(instid, model, property_name, cache_ttl=None):
     if flask.request.method == "GET":
-        return get_object_property(instid, model, property_name)
+        return get_object_property(instid, model, property_name, cache_ttl)
     else:
         return set_object_property(instid, model, property_name)
 
 
-def get_object_property(instid, model, property_name):
-    instance = model.query.get(instid)
+def get_object_property(instid, model, property_name, cache_ttl=None):
+    cache_key = (model, str(instid), property_name, None)
+    if cache_ttl is not None:
+        payload = result_cache().get(cache_key)
+        if payload is not None:
+            return rpc_response(payload)
+
+    instance = get_instance(model, instid)
     if not instance:
         return {}
-    result = getattr(instance, property_name)
-    return json.dumps({"payload": cr().dumps(result)})
+    payload = cr().dumps(getattr(instance, property_name))
+    if cache_ttl is not None:
+        result_cache().set(cache_key, payload, cache_ttl)
+    return rpc_response(payload)
+
+
+def object_properties(model, property_names, settable_names=()):
+    if flask.request.method == "GET":
+        return get_object_properties(model, property_names)
+    else:
+        return set_object_properties(model, settable_names)
+
+
+def get_object_properties(model, property_names):
+    """
+    Read several properties of several instances in one request, the ids and
+    names are passed as repeated `instid` and `name` query arguments. All
+    instances are loaded in a single query, instances that don't exist are left
+    out of the result.
+    """
+    instids = flask.request.args.getlist("instid")
+    names = flask.request.args.getlist("name") or property_names
+    unknown = [name for name in names if name not in property_names]
+    if unknown:
+        abort("Unknown properties: {}".format(", ".join(unknown)), 400)
+
+    result = {}
+    try:
+        for instid, instance in get_instances(model, instids).items():
+            result[instid] = {name: getattr(instance, name) for name in names}
+        payload = cr().dumps(result)
+    except Exception as e:
+        abort(error_message(e))
+    return rpc_response(payload)
 
 
 def set_object_property(instid, model, property_name):
-    instance = model.query.get(instid)
+    instance = get_instance(model, instid)
     if not instance:
         return {}
 
-    value = cr().loads(flask.request.get_json())
+    value = load_payload(request_payload(enveloped=False))
+    session = Session.object_session(instance)
     try:
         setattr(instance, property_name, value)
-        session = Session.object_session(instance)
-        session.commit()
+        if has_changes(session):
+            session.commit()
     except Exception as e:
+        session.rollback()
         abort("Could not set property: {}".format(e))
-    return json.dumps({"message": "success"})
+    result_cache().invalidate(model, instid)
+    return json_backend().dumps({"message": "success"})
+
+
+def set_object_properties(model, settable_names):
+    """
+    Set properties of several instances in a single transaction. The payload
+    maps instance ids to the properties to set on them, nothing is committed
+    unless every instance exists and every property could be set.
+    """
+    values = load_payload(request_payload(enveloped=False))
+    if not isinstance(values, dict):
+        abort("Expected a mapping of instance ids to properties", 400)
+    if not all(isinstance(properties, dict) for properties in values.values()):
+        abort("Expected a mapping of property names to values per instance", 400)
+    names = {name for properties in values.values() for name in properties}
+    unknown = sorted(names.difference(settable_names))
+    if unknown:
+        abort("Unknown or read-only properties: {}".format(", ".join(unknown)), 400)
+    instances = get_instances(model, list(values))
+    missing = [str(instid) for instid in values if str(instid) not in instances]
+    if missing:
+        abort("No instances with ids: {}".format(", ".join(missing)), 404)
+
+    session = model.query.session
+    try:
+        for instid, properties in values.items():
+            for name, value in properties.items():
+                setattr(instances[str(instid)], name, value)
+        if has_changes(session):
+            session.commit()
+    except Exception as e:
+        session.rollback()
+        abort("Could not set properties: {}".format(e))
+    for instid in values:
+        result_cache().invalidate(model, instid)
+    return json_backend().dumps({"message": "success"})
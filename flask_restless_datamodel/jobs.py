@@ -0,0 +1,140 @@
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import flask
+from sqlalchemy.orm.session import Session
+
+from .helpers import (
+    abort,
+    check_call,
+    cr,
+    decode_payload,
+    end_transaction,
+    error_message,
+    get_instance,
+    load_payload,
+    request_payload,
+    result_cache,
+    rpc_response,
+)
+
+JOB_MARKER = "_datamodel_run_as_job"
+
+
+def run_as_job(fn):
+    """
+    Mark an exposed model method to run as a background job. Calling it over
+    RPC returns a job id straight away, the outcome is served on
+    `/job/<job_id>`.
+    """
+    setattr(fn, JOB_MARKER, True)
+    return fn
+
+
+def is_job(fn):
+    fn = getattr(fn, "__func__", fn)
+    return getattr(fn, JOB_MARKER, False)
+
+
+class JobQueue:
+    """
+    Runs jobs on a bounded thread pool. At most `max_jobs` jobs are kept,
+    counting both unfinished jobs and finished jobs whose outcome wasn't
+    fetched yet. When full, the oldest finished job is forgotten to make
+    room; new jobs are only refused while all kept jobs are unfinished.
+    """
+
+    def __init__(self, max_workers=4, max_jobs=100):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="datamodel-job"
+        )
+        self.max_jobs = max_jobs
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if len(self.jobs) >= self.max_jobs:
+                finished = next(
+                    (job_id for job_id, job in self.jobs.items() if job.done()), None
+                )
+                if finished is None:
+                    return None
+                del self.jobs[finished]
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = self.executor.submit(fn, *args)
+        return job_id
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def discard(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+
+def jobs():
+    return flask.current_app.extensions["datamodel_jobs"]
+
+
+def run_job(app, model, instid, function_name, payload, commit_on_return):
+    # the worker has its own app context, and thus its own session
+    with app.app_context():
+        instance = get_instance(model, instid)
+        if not instance:
+            raise LookupError(f"no instance with id {instid}")
+        session = Session.object_session(instance)
+        try:
+            params = load_payload(payload)
+            method = getattr(instance, function_name)
+            payload = cr().dumps(method(*params["args"], **params["kwargs"]))
+        except Exception:
+            session.rollback()
+            raise
+        end_transaction(session, commit_on_return)
+        if commit_on_return:
+            result_cache().invalidate(model, instid)
+        return payload
+
+
+def submit_object_method(instid, function_name, model, commit_on_return, binder=None):
+    """
+    Submit a method call as a job. The payload is only loaded in the worker,
+    so the instances it references belong to the worker's session.
+    """
+    payload = request_payload()
+    check_call(binder, decode_payload(payload))
+    if not get_instance(model, instid):
+        return {}
+    app = flask.current_app._get_current_object()
+    job_id = jobs().submit(
+        run_job, app, model, instid, function_name, payload, commit_on_return
+    )
+    if job_id is None:
+        abort("Too many pending jobs, try again later", status_code=503)
+    response = flask.jsonify(job_id=job_id)
+    response.status_code = 202
+    response.headers["Location"] = flask.url_for(".job_status", job_id=job_id)
+    return response
+
+
+def job_status(job_id):
+    """
+    The outcome of a job: a 202 while it is still running, afterwards the
+    same response as a direct call would have given. A finished job is
+    forgotten once its outcome is served.
+    """
+    future = jobs().get(job_id)
+    if future is None:
+        abort(f"No job with id {job_id}", status_code=404)
+    if not future.done():
+        response = flask.jsonify(status="pending")
+        response.status_code = 202
+        return response
+    jobs().discard(job_id)
+    try:
+        payload = future.result()
+    except Exception as e:
+        abort(error_message(e))
+    return rpc_response(payload)
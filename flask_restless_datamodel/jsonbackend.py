@@ -0,0 +1,39 @@
+import json
+from collections import namedtuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# dumps should return bytes, loads should accept both bytes and str
+JSONBackend = namedtuple("JSONBackend", "dumps loads")
+
+
+def stdlib_backend():
+    return JSONBackend(lambda obj: json.dumps(obj).encode("utf-8"), json.loads)
+
+
+def orjson_backend():
+    if orjson is None:
+        raise ImportError("The orjson json backend requires orjson to be installed")
+    # polymorphic identities aren't necessarily strings
+    return JSONBackend(
+        lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), orjson.loads
+    )
+
+
+BACKENDS = {"json": stdlib_backend, "orjson": orjson_backend}
+
+
+def get_json_backend(backend=None):
+    """
+    Resolve the `json_backend` option: the name of a known backend, an object
+    with `dumps` and `loads` functions, or None to use orjson when it is
+    installed and the standard library otherwise.
+    """
+    if backend is None:
+        backend = "json" if orjson is None else "orjson"
+    if isinstance(backend, str):
+        return BACKENDS[backend]()
+    return JSONBackend(backend.dumps, backend.loads)
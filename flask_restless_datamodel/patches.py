@@ -1,20 +1,32 @@
+import functools
+import importlib
 import inspect
-import sys
 
 import flask_restless
-from pbr.version import SemanticVersion, VersionInfo
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.inspection import inspect as sqla_inspect
+
+
+# mapper based lookups, memoized per model class until mappers are reconfigured
+_primary_key_names = {}
+_relations = {}
+_like_list = {}
+_sub_operations = {}
+_submodels = {}
 
 
 def primary_key_names(model):
     """Returns all the primary keys for a model."""
-    return [
-        key
-        for key, field in inspect.getmembers(model)
-        if isinstance(field, QueryableAttribute)
-        and hasattr(field, "property")
-        and isinstance(field.property, ColumnProperty)
-        and field.property.columns[0].primary_key
-    ]
+    if model not in _primary_key_names:
+        mapper = sqla_inspect(model, raiseerr=False)
+        names = []
+        if mapper is not None:
+            names = sorted(
+                prop.key for prop in mapper.column_attrs if prop.columns[0].primary_key
+            )
+        _primary_key_names[model] = names
+    return _primary_key_names[model]
 
 
 def get_related_model(model, relationname):
@@ -33,6 +45,8 @@ def get_related_model(model, relationname):
 
 def get_relations(model):
     """Returns a list of relation names of `model` (as a list of strings)."""
+    if model in _relations:
+        return _relations[model]
 
     def is_accepted(k):
         return (
@@ -42,7 +56,25 @@ def get_relations(model):
             and get_related_model(model, k)
         )
 
-    return [k for k in dir(model) if is_accepted(k)]
+    candidates = set()
+    mapper = sqla_inspect(model, raiseerr=False)
+    if mapper is not None:
+        candidates.update(mapper.relationships.keys())
+        candidates.update(
+            key
+            for key, descriptor in mapper.all_orm_descriptors.items()
+            if descriptor.extension_type is ASSOCIATION_PROXY
+        )
+    _relations[model] = [k for k in sorted(candidates) if is_accepted(k)]
+    return _relations[model]
+
+
+def clear_mapper_caches():
+    _primary_key_names.clear()
+    _relations.clear()
+    _like_list.clear()
+    _sub_operations.clear()
+    _submodels.clear()
 
 
 def is_like_list(instance, relation):
@@ -53,13 +85,18 @@ def is_like_list(instance, relation):
     relation, or it is a dynamically loaded one-to-many.
 
     """
-    if relation in instance._sa_class_manager:
-        return instance._sa_class_manager[relation].property.uselist
-    elif hasattr(instance, relation):
-        attr = getattr(instance._sa_instance_state.class_, relation)
-        if hasattr(attr, "property"):
-            return attr.property.uselist
-    related_value = getattr(type(instance), relation, None)
+    key = (type(instance), relation)
+    if key not in _like_list:
+        _like_list[key] = relation_is_like_list(type(instance), relation)
+    return _like_list[key]
+
+
+def relation_is_like_list(model, relation):
+    if relation in model._sa_class_manager:
+        return model._sa_class_manager[relation].property.uselist
+    related_value = getattr(model, relation, None)
+    if hasattr(related_value, "property"):
+        return related_value.property.uselist
     if isinstance(related_value, ASSOCIATION_PROXIES_KLASSES):
         local_prop = related_value.local_attr.prop
         if isinstance(local_prop, RelProperty):
@@ -67,63 +104,145 @@ def is_like_list(instance, relation):
     return False
 
 
+def prime_is_like_list(model):
+    """Fill the `is_like_list` cache for every relation of a model."""
+    for relation in get_relations(model):
+        _like_list[(model, relation)] = relation_is_like_list(model, relation)
+
+
 def _sub_operator(model, argument, fieldname):
-    """Recursively calls :func:`QueryBuilder._create_operation` when argument
-    is a dictionary of the form specified in :ref:`search`.
+    """Creates the operation on the related model when argument is a
+    dictionary of the form specified in :ref:`search`, like
+    :func:`QueryBuilder._create_operation` does.
     This function is for use with the ``has`` and ``any`` search operations.
+
+    Everything but the value of the filter is resolved once per relation,
+    field name and operator, and then reused.
     """
-    if isinstance(model, InstrumentedAttribute):
-        submodel = model.property.mapper.class_
-    elif isinstance(model, ASSOCIATION_PROXIES_KLASSES):
-        submodel = get_related_association_proxy_model(model)
-    else:  # TODO what to do here?
-        pass
     if isinstance(argument, dict):
-        fieldname = argument["name"]
+        name = argument["name"]
         operator = argument["op"]
         argument = argument.get("val")
-        relation = None
-        if "__" in fieldname:
-            fieldname, relation = fieldname.split("__")
-        return QueryBuilder._create_operation(
-            submodel, fieldname, operator, argument, relation
-        )
-    # Support legacy has/any with implicit eq operator
-    return getattr(submodel, fieldname) == argument
+    else:
+        # Support legacy has/any with implicit eq operator
+        name = fieldname
+        operator = None
+    key = (relation_key(model), name, operator)
+    if key not in _sub_operations:
+        _sub_operations[key] = compile_sub_operation(model, name, operator)
+    return _sub_operations[key](argument)
+
+
+def relation_key(attribute):
+    if isinstance(attribute, InstrumentedAttribute):
+        return (attribute.class_, attribute.key)
+    if isinstance(attribute, ObjectAssociationProxyInstance):
+        return (attribute.owning_class, attribute.parent.key)
+    return attribute
+
+
+def related_submodel(attribute):
+    key = relation_key(attribute)
+    if key not in _submodels:
+        submodel = None
+        if isinstance(attribute, InstrumentedAttribute):
+            submodel = attribute.property.mapper.class_
+        elif isinstance(attribute, ASSOCIATION_PROXIES_KLASSES):
+            submodel = get_related_association_proxy_model(attribute)
+        _submodels[key] = submodel
+    return _submodels[key]
+
+
+def compile_sub_operation(model, name, operator):
+    """Resolve the related model, field and operator function of a ``has`` or
+    ``any`` filter, and return a function building its expression for a value.
+
+    """
+    submodel = related_submodel(model)
+    if operator is None:
+        field = getattr(submodel, name)
+        return lambda argument: field == argument
+
+    fieldname = name
+    relation = None
+    if "__" in fieldname:
+        fieldname, relation = fieldname.split("__")
+    # raises KeyError if operator not in OPERATORS
+    opfunc = OPERATORS[operator]
+    numargs = len(inspect.signature(opfunc).parameters)
+    # raises AttributeError if `fieldname` or `relation` does not exist
+    field = getattr(submodel, relation or fieldname)
+
+    def build(argument):
+        if numargs == 1:
+            return opfunc(field)
+        if argument is None:
+            msg = "To compare a value to NULL, use the is_null/is_not_null operators."
+            raise TypeError(msg)
+        if numargs == 2:
+            return opfunc(field, argument)
+        return opfunc(field, argument, fieldname)
+
+    return build
+
+
+# the flask-restless modules that look the patched functions up as globals
+PATCH_TARGETS = {
+    "flask_restless.helpers": (
+        "primary_key_names",
+        "get_related_model",
+        "get_relations",
+        "is_like_list",
+    ),
+    "flask_restless.search": ("primary_key_names", "_sub_operator"),
+    "flask_restless.views": ("get_related_model", "get_relations", "is_like_list"),
+}
+_applied = False
 
 
 def apply_patches():
-    needs_patching = (
-        primary_key_names,
-        get_related_model,
-        get_relations,
-        is_like_list,
-        _sub_operator,
-    )
+    global _applied
+    if _applied:
+        return
+    patches = {
+        func.__name__: func
+        for func in (
+            primary_key_names,
+            get_related_model,
+            get_relations,
+            is_like_list,
+            _sub_operator,
+        )
+    }
+    for module_name, funcnames in PATCH_TARGETS.items():
+        module = importlib.import_module(module_name)
+        for funcname in funcnames:
+            setattr(module, funcname, patches[funcname])
+    _applied = True
+
 
-    for func in needs_patching:
-        funcname = func.__name__
-        restless_mods = [m for m in sys.modules if m.startswith("flask_restless")]
-        for mod in restless_mods:
-            if funcname in dir(sys.modules[mod]):
-                setattr(sys.modules[mod], funcname, func)
+@functools.lru_cache(maxsize=None)
+def sqlalchemy_version():
+    """The major and minor version of SQLAlchemy, without reading metadata."""
+    return tuple(int(part) for part in sqlalchemy.__version__.split(".")[:2])
 
 
-sqla_version = VersionInfo("sqlalchemy").semantic_version()
-if sqla_version >= SemanticVersion(1, 3, 0):
+if sqlalchemy_version() >= (1, 3):
     from sqlalchemy.ext.associationproxy import (
+        ASSOCIATION_PROXY,
         AssociationProxy,
         ObjectAssociationProxyInstance,
     )
-    from sqlalchemy.orm import RelationshipProperty as RelProperty, ColumnProperty
-    from sqlalchemy.orm.attributes import QueryableAttribute, InstrumentedAttribute
+    from sqlalchemy.orm import Mapper, RelationshipProperty as RelProperty
+    from sqlalchemy.orm.attributes import InstrumentedAttribute
     from flask_restless.helpers import get_related_association_proxy_model
-    from flask_restless.search import QueryBuilder
+    from flask_restless.search import OPERATORS
 
     ASSOCIATION_PROXIES_KLASSES = (AssociationProxy, ObjectAssociationProxyInstance)
+    event.listen(Mapper, "after_configured", clear_mapper_caches)
     apply_patches()
 
-if sqla_version >= SemanticVersion(2, 0, 0):
+if sqlalchemy_version() >= (2, 0):
     flask_restless.helpers.hybrid.HYBRID_PROPERTY = (
         flask_restless.helpers.hybrid.HybridExtensionType.HYBRID_PROPERTY
     )
@@ -1,4 +1,8 @@
+import hashlib
 import inspect
+import json
+from collections import namedtuple
+from types import FunctionType
 
 from flask_restless.helpers import get_related_association_proxy_model, primary_key_name
 from sqlalchemy.ext.associationproxy import AssociationProxy  # noqa
@@ -8,11 +12,24 @@ from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.inspection import inspect as sqla_inspect
 from sqlalchemy.orm.properties import ColumnProperty, RelationshipProperty
 
-from .helpers import object_property, register_serializer, run_object_method
+from .cache import cache_ttl
+from .helpers import (
+    object_properties,
+    object_property,
+    register_serializer,
+    run_batch_object_method,
+    run_object_method,
+)
+from .jobs import is_job, submit_object_method
 
 INCLUDE_INTERNAL = "include_model_internal_functions"
 COMMIT_ON_RETURN = "commit_on_method_return"
 EXPOSE_PROPERTY = "expose_property"
+RESULT_CACHE_TTL = "result_cache_ttl"
+
+ModelAttributes = namedtuple(
+    "ModelAttributes", "columns relations properties hybrids proxies methods"
+)
 
 
 def clean(columns):
@@ -48,18 +65,151 @@ def verify_association_attr(k, v):
     return True
 
 
+def class_namespace(model):
+    namespace = {}
+    for klass in reversed(model.__mro__):
+        namespace.update(vars(klass))
+    return namespace
+
+
+def classify_attributes(model):
+    """
+    Sort every attribute of a model into columns, relations, properties,
+    hybrid properties, association proxies and methods, in a single pass.
+
+    Attributes are looked up in the class dicts along the mro rather than
+    with getattr, so no descriptor (hybrid expressions, the flask-sqlalchemy
+    query property, ...) gets triggered while doing so.
+    """
+    mapper = sqla_inspect(model)
+    namespace = class_namespace(model)
+
+    properties = {}
+    hybrids = {}
+    proxies = {}
+    methods = {}
+    for name in sorted(namespace):
+        value = namespace[name]
+        if isinstance(value, property):
+            properties[name] = value
+        elif isinstance(value, hybrid_property):
+            hybrids[name] = value
+        elif isinstance(value, FunctionType):
+            methods[name] = value
+        elif isinstance(value, staticmethod):
+            methods[name] = value.__func__
+        elif verify_association_attr(name, value):
+            if isinstance(
+                value, (ObjectAssociationProxyInstance, ColumnAssociationProxyInstance)
+            ):
+                value = value.parent
+            if isinstance(value, AssociationProxy):
+                proxies[name] = value
+
+    return ModelAttributes(
+        mapper.columns, mapper.relationships, properties, hybrids, proxies, methods
+    )
+
+
+def method_signature(fn):
+    signature = inspect.signature(fn)
+    parameters = [p for name, p in signature.parameters.items() if name != "self"]
+    return signature.replace(parameters=parameters)
+
+
+def describe_proxy(model, proxy):
+    remote_attr = proxy.__get__(None, model).remote_attr
+    remote_property = getattr(remote_attr, "property", None)
+    if isinstance(remote_property, RelationshipProperty):
+        return ["relation", remote_property.mapper.class_.__name__]
+    if isinstance(remote_property, ColumnProperty):
+        return ["column", type(remote_property.columns[0].type).__name__]
+    return None
+
+
+def fingerprint_model(model, config, options):
+    """
+    Hash everything a render of the model depends on: its mapper
+    configuration, its class attributes, the include and exclude columns of
+    its flask-restless view and the render options. Like the render itself,
+    this only looks at the class dicts and doesn't trigger descriptors.
+    """
+    mapper = sqla_inspect(model)
+    attributes = {}
+    for name, value in class_namespace(model).items():
+        if not verify_association_attr(name, value):
+            # these are caches named after the id of the proxy
+            continue
+        if isinstance(value, staticmethod):
+            value = value.__func__
+        if isinstance(value, FunctionType):
+            # the signature the render uses, which follows `__wrapped__`
+            attributes[name] = ["method", str(method_signature(value))]
+        elif isinstance(value, property):
+            attributes[name] = ["property", value.fset is not None]
+        elif isinstance(value, AssociationProxy):
+            attributes[name] = ["proxy", describe_proxy(model, value)]
+        elif name == "__mapper_args__" and isinstance(value, dict):
+            attributes[name] = ["mapper_args", dict(value)]
+        else:
+            attributes[name] = type(value).__name__
+
+    view = config.view
+    description = {
+        "collection_name": config.collection_name,
+        "url_prefix": config.blueprint.url_prefix,
+        "include_columns": sorted(clean(view.include_columns)),
+        "exclude_columns": sorted(clean(view.exclude_columns)),
+        "options": [options.get(INCLUDE_INTERNAL), options.get(EXPOSE_PROPERTY)],
+        "columns": [
+            [c.name, type(c.type).__name__, c.primary_key] for c in mapper.columns
+        ],
+        "relations": [
+            [
+                r.key,
+                r.direction.name,
+                r.mapper.class_.__name__,
+                r.uselist,
+                r.back_populates,
+                sorted(c.key for c in r.local_columns),
+            ]
+            for r in mapper.relationships
+        ],
+        "attributes": attributes,
+    }
+    encoded = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+
 class DataModelRenderer:
     def __init__(self, app, db, options):
         self.app = app
         self.options = options
 
     def render(self, model, config):
-        klass = ClassDefinitionRenderer(self.app, self.options, model, config)
-        methods = MethodDefinitionRenderer(self.options, model, config)
+        attributes = classify_attributes(model)
+        klass = ClassDefinitionRenderer(
+            self.app, self.options, model, config, attributes
+        )
+        methods = MethodDefinitionRenderer(self.options, model, config, attributes)
         model_render = klass.render()
         model_render["methods"] = methods.render()
         return model_render
 
+    def restore(self, model, config, model_render):
+        """
+        Register the serializer and RPC endpoints of a model based on an
+        earlier render of it, without introspecting the model again.
+        """
+        klass = ClassDefinitionRenderer(self.app, self.options, model, config, None)
+        klass.register_serializer(model_render["pk_name"])
+        klass.add_property_endpoints(model_render["properties"])
+        methods = MethodDefinitionRenderer(self.options, model, config, None)
+        methods.add_method_endpoints(model_render["methods"])
+
+    def fingerprint(self, model, config):
+        return fingerprint_model(model, config, self.options)
+
     def render_polymorphic(self, model, identities):
         polymorphic_info = {}
         if is_polymorphic(model, "polymorphic_on"):
@@ -79,17 +229,17 @@ class DataModelRenderer:
 
 
 class ClassDefinitionRenderer:
-    def __init__(self, app, options, model, config):
+    def __init__(self, app, options, model, config, attributes):
         self.app = app
         self.model = model
         self.options = options
         self.config = config
+        self.attributes = attributes
         self.is_valid = get_is_valid_validator(
             clean(config.view.include_columns), clean(config.view.exclude_columns)
         )
 
     def render(self):
-        view = self.config.view
         collection_name = self.config.collection_name
 
         attribute_dict = self.render_attributes()
@@ -102,9 +252,7 @@ class ClassDefinitionRenderer:
 
         with self.app.app_context():
             pk_name = primary_key_name(self.model)
-
-        cr = self.app.extensions["cereal"]
-        register_serializer(self.model, pk_name, view.serialize, view.deserialize, cr)
+        self.register_serializer(pk_name)
 
         return {
             "pk_name": pk_name,
@@ -115,9 +263,14 @@ class ClassDefinitionRenderer:
             "properties": properties,
         }
 
+    def register_serializer(self, pk_name):
+        view = self.config.view
+        cr = self.app.extensions["cereal"]
+        register_serializer(self.model, pk_name, view.serialize, view.deserialize, cr)
+
     def render_attributes(self):
         attribute_dict = {}
-        for column in sqla_inspect(self.model).columns:
+        for column in self.attributes.columns:
             if self.is_valid(column.name):
                 ctype = column.type.__class__.__name__.lower()
                 attribute_dict[column.name] = ctype
@@ -125,7 +278,7 @@ class ClassDefinitionRenderer:
 
     def render_relations(self):
         foreign_keys = {}
-        for rel in sqla_inspect(self.model).relationships:
+        for rel in self.attributes.relations:
             if self.is_valid(str(rel.key)):
                 direction = rel.direction.name
                 if rel.direction.name == "ONETOMANY" and not rel.uselist:
@@ -142,27 +295,16 @@ class ClassDefinitionRenderer:
 
     def render_properties(self):
         attribute_dict = {}
-        properties = [
-            (a, getattr(self.model, a).fset is not None)
-            for a in dir(self.model)
-            if isinstance(getattr(self.model, a), property)
-        ]
-        for attribute, settable in properties:
+        for attribute, prop in self.attributes.properties.items():
             if self.is_valid(attribute):
-                self.add_property_endpoint(attribute)
-                attribute_dict[attribute] = settable
+                attribute_dict[attribute] = prop.fset is not None
+        self.add_property_endpoints(attribute_dict)
 
         return attribute_dict
 
     def render_hybrid_properties(self):
         attribute_dict = {}
-        hybrid_properties = [
-            a
-            for a in sqla_inspect(self.model).all_orm_descriptors
-            if isinstance(a, hybrid_property)
-        ]
-        for attribute in hybrid_properties:
-            name = attribute.__name__
+        for name in self.attributes.hybrids:
             if self.is_valid(name):
                 attribute_dict[name] = "hybrid"
         return attribute_dict
@@ -170,24 +312,15 @@ class ClassDefinitionRenderer:
     def render_association_proxies(self, attribute_dict, foreign_keys):
         proxies = {}
 
-        for k in dir(self.model):
-            v = getattr(self.model, k)
-            if not verify_association_attr(k, v):
-                continue
-            if isinstance(
-                v, (ObjectAssociationProxyInstance, ColumnAssociationProxyInstance)
-            ):
-                v = v.parent
-            is_proxy = isinstance(v, AssociationProxy)
+        for k, v in self.attributes.proxies.items():
             # keep the proxies where the remote attr has a property,
             # as we need this property to identify the remote class
             # but not all cases have it.
             # v == v.__get__(None, model), but we do this to bind the model to
             # the remote_attr and from then on it's usable for further inspection
-            if is_proxy and hasattr(
-                v.__get__(None, self.model).remote_attr, "property"
-            ):
-                proxies[k] = v.__get__(None, self.model)
+            bound = v.__get__(None, self.model)
+            if hasattr(bound.remote_attr, "property"):
+                proxies[k] = bound
 
         for name, attr in proxies.items():
             # check if the remote attr is a relation (for example, an association
@@ -207,22 +340,51 @@ class ClassDefinitionRenderer:
                 column = attr.remote_attr.property.columns[0]
                 attribute_dict[name] = column.type.__class__.__name__.lower()
 
-    def add_property_endpoint(self, property_name):
+    def add_property_endpoints(self, property_names):
+        namespace = class_namespace(self.model)
+        default_ttl = self.options.get(RESULT_CACHE_TTL, 60)
+        for property_name in property_names:
+            ttl = cache_ttl(namespace[property_name], default_ttl)
+            self.add_property_endpoint(property_name, ttl)
+        if property_names:
+            self.add_bulk_property_endpoint(property_names)
+
+    def add_bulk_property_endpoint(self, property_names):
+        endpoint = "/property/{0}".format(self.config.collection_name)
+        settable_names = tuple(name for name, fset in property_names.items() if fset)
+        self.config.rpc_blueprint.add_url_rule(
+            endpoint,
+            methods=["GET", "POST"],
+            defaults={
+                "model": self.model,
+                "property_names": tuple(property_names),
+                "settable_names": settable_names,
+            },
+            view_func=object_properties,
+        )
+
+    def add_property_endpoint(self, property_name, ttl=None):
         fmt = "/property/{0}/<instid>/{1}"
         endpoint = fmt.format(self.config.collection_name, property_name)
+        defaults = {"model": self.model, "property_name": property_name}
+        if ttl is not None:
+            defaults["cache_ttl"] = ttl
         self.config.rpc_blueprint.add_url_rule(
             endpoint,
             methods=["GET", "POST"],
-            defaults={"model": self.model, "property_name": property_name},
+            defaults=defaults,
             view_func=object_property,
         )
 
 
 class MethodDefinitionRenderer:
-    def __init__(self, options, model, config):
+    def __init__(self, options, model, config, attributes):
         self.options = options
         self.model = model
         self.config = config
+        self.attributes = attributes
+        # signatures without self, to check the arguments of calls against
+        self.binders = {}
 
     def render(self):
         methods = self.compile_method_list()
@@ -233,7 +395,7 @@ class MethodDefinitionRenderer:
         methods = {}
         attributes_and_methods_to_exclude = self.config.view.exclude_columns
         include_internal = self.options.get(INCLUDE_INTERNAL, False)
-        for name, fn in inspect.getmembers(self.model, predicate=inspect.isfunction):
+        for name, fn in self.attributes.methods.items():
             if name.startswith("__"):
                 continue
             if name.startswith("_") and not include_internal:
@@ -242,14 +404,13 @@ class MethodDefinitionRenderer:
                 if name in attributes_and_methods_to_exclude:
                     continue
 
-            spec = inspect.signature(fn)
+            spec = method_signature(fn)
+            self.binders[name] = spec
             required = []
             optional = []
             argsvar = None
             kwargsvar = None
             for param_name, param in spec.parameters.items():
-                if param_name == "self":
-                    continue
                 if param.kind == param.VAR_KEYWORD:
                     kwargsvar = param_name
                 elif param.kind == param.VAR_POSITIONAL:
@@ -270,16 +431,45 @@ class MethodDefinitionRenderer:
     def add_method_endpoints(self, methods):
         commit_on_return = self.options.get(COMMIT_ON_RETURN, False)
         collection_name = self.config.collection_name
+        namespace = class_namespace(self.model)
+        default_ttl = self.options.get(RESULT_CACHE_TTL, 60)
         for method in methods.keys():
             fmt = "/method/{0}/<instid>/{1}"
             instance_endpoint = fmt.format(collection_name, method)
+            if method not in self.binders:
+                fn = namespace[method]
+                self.binders[method] = method_signature(getattr(fn, "__func__", fn))
+            defaults = {
+                "function_name": method,
+                "model": self.model,
+                "commit_on_return": commit_on_return,
+                "binder": self.binders[method],
+            }
+            view_func = run_object_method
+            if is_job(namespace[method]):
+                view_func = submit_object_method
+            else:
+                ttl = cache_ttl(namespace[method], default_ttl)
+                if ttl is not None:
+                    defaults["cache_ttl"] = ttl
             self.config.rpc_blueprint.add_url_rule(
                 instance_endpoint,
                 methods=["POST"],
+                defaults=defaults,
+                view_func=view_func,
+            )
+            if is_job(namespace[method]):
+                # jobs are only submitted one instance at a time
+                continue
+            batch_endpoint = "/method/{0}/{1}".format(collection_name, method)
+            self.config.rpc_blueprint.add_url_rule(
+                batch_endpoint,
+                methods=["POST"],
                 defaults={
                     "function_name": method,
                     "model": self.model,
                     "commit_on_return": commit_on_return,
+                    "binder": self.binders[method],
                 },
-                view_func=run_object_method,
+                view_func=run_batch_object_method,
             )
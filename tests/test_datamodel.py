@@ -1,12 +1,37 @@
+import functools
+import json
+import subprocess
+import sys
+import threading
 from datetime import date
 
+import flask
 import flask_restless
 import pytest
+import sqlalchemy
 from cereal_lazer import Cereal
-from flask_restless_datamodel import DataModel, __version__
+from flask_restless.helpers import primary_key_name
+from flask_restless_datamodel import (
+    DataModel,
+    __version__,
+    cache_result,
+    patches,
+    run_as_job,
+)
+from flask_restless_datamodel.datamodel import catch_model_view
+from flask_restless_datamodel.helpers import (
+    CEREAL_MIMETYPE,
+    META_KEY,
+    get_instance,
+    identity_cache,
+)
+from flask_restless_datamodel.jobs import JobQueue
+from flask_restless_datamodel.patches import get_relations, primary_key_names
+from flask_restless_datamodel.render import DataModelRenderer
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import configure_mappers
 
 
 def test_datamodel(app, client_maker):
@@ -163,7 +188,7 @@ def exposed_method_model_app_with_commit(app):
     return _exposed_method_model_app(app, commit_before_return=True)
 
 
-def _exposed_method_model_app(app, commit_before_return=False):
+def _exposed_method_model_app(app, commit_before_return=False, **options):
     db = SQLAlchemy(app)
 
     class Person(db.Model):
@@ -213,6 +238,12 @@ def _exposed_method_model_app(app, commit_before_return=False):
         def reset_secret_key(self):
             self.secret_key = None
 
+        def count_to(self, n):
+            return (i for i in range(1, n + 1))
+
+        def everyone(self):
+            return Person.query.order_by(Person.id)
+
     app.Person = Person
     db.create_all()
 
@@ -225,9 +256,11 @@ def _exposed_method_model_app(app, commit_before_return=False):
         manager,
         include_model_functions=True,
         commit_on_method_return=commit_before_return,
+        **options,
     )
     manager.create_api(data_model, methods=["GET"])
     data_model.register_rpc_blueprint()
+    app.data_model = data_model
 
     return app
 
@@ -294,6 +327,18 @@ def test_exposed_methods(exposed_method_model_app, client_maker):
                     "argsvar": None,
                     "kwargsvar": None,
                 },
+                "count_to": {
+                    "args": ["n"],
+                    "kwargs": [],
+                    "argsvar": None,
+                    "kwargsvar": None,
+                },
+                "everyone": {
+                    "args": [],
+                    "kwargs": [],
+                    "argsvar": None,
+                    "kwargsvar": None,
+                },
             },
         },
     }
@@ -481,3 +526,1197 @@ def test_it_can_set_a_property(exposed_method_model_app, client_maker):
     res = client.post(url, json=body)
     person = app.Person.query.get(1)
     assert person.name == expected
+
+
+def test_datamodel_is_served_with_an_etag(app, client_maker):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    class Computer(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    db.create_all()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Person, methods=["GET"])
+    data_model = DataModel(manager)
+    manager.create_api(data_model, methods=["GET"])
+
+    # registering a new model changes the payload, and thus the etag
+    stale_etag = data_model.serialized_data_model.etag
+    manager.create_api(Computer, methods=["GET"])
+
+    client = client_maker(app)
+    url = "http://app/api/flask-restless-datamodel"
+    res = client.get(url, headers={"If-None-Match": f'"{stale_etag}"'})
+    etag = res.headers["ETag"]
+    assert res.status_code == 200
+    assert etag != f'"{stale_etag}"'
+    assert "Computer" in res.json()
+
+    res = client.get(url, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.content == b""
+
+
+def test_datamodel_is_served_precompressed(app, client_maker):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    db.create_all()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Person, methods=["GET"])
+    data_model = DataModel(manager)
+    manager.create_api(data_model, methods=["GET"])
+
+    client = client_maker(app)
+    url = "http://app/api/flask-restless-datamodel"
+    res = client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert res.headers["Content-Encoding"] == "gzip"
+    assert res.headers["Vary"] == "Accept-Encoding"
+    assert "Person" in res.json()
+    gzip_etag = res.headers["ETag"]
+
+    res = client.get(url, headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in res.headers
+    assert "Person" in res.json()
+    assert res.headers["ETag"] != gzip_etag
+
+    res = client.get(
+        url, headers={"Accept-Encoding": "gzip", "If-None-Match": gzip_etag}
+    )
+    assert res.status_code == 304
+
+
+def test_models_are_registered_in_a_single_stub_request(app, client_maker):
+    db = SQLAlchemy(app)
+    models = [
+        type(f"Model{i}", (db.Model,), {"id": db.Column(db.Integer, primary_key=True)})
+        for i in range(5)
+    ]
+    db.create_all()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    data_model = DataModel(manager)
+    for model in models:
+        manager.create_api(model, methods=["GET"], exclude_columns=["id"])
+
+    stub_requests = []
+    build_stub_environ = data_model.build_stub_environ
+
+    def counting_build_stub_environ(app):
+        stub_requests.append(app)
+        return build_stub_environ(app)
+
+    data_model.build_stub_environ = counting_build_stub_environ
+    manager.create_api(data_model, methods=["GET"])
+    assert len(stub_requests) == 1
+
+    client = client_maker(app)
+    res = client.get("http://app/api/flask-restless-datamodel").json()
+    for model in models:
+        assert res[model.__name__]["attributes"] == {}
+
+
+def test_lazy_rendering_waits_for_the_first_datamodel_request(app, client_maker):
+    app = _exposed_method_model_app(app, render_lazily=True)
+    data_model = app.data_model
+    assert list(data_model.data_model) == ["FlaskRestlessDatamodel"]
+    assert "cereal" in app.extensions
+    assert "Person" not in app.extensions["cereal"].class_from_name
+
+    client = client_maker(app)
+    res = client.get("http://app/api/flask-restless-datamodel").json()
+    assert "age_in_x_years_y_months" in res["Person"]["methods"]
+
+    # the rpc endpoints were added after the rpc blueprint got registered
+    sr = app.extensions["cereal"]
+    url = "http://app/api/method/person/1/age_in_x_years_y_months"
+    body = to_method_params({"args": [10], "kwargs": {}}, sr)
+    res = sr.loads(client.post(url, json=body).json()["payload"])
+    assert res == date(2028, 1, 1)
+
+
+def test_lazy_rendering_can_be_finalized_explicitly(app, client_maker):
+    app = _exposed_method_model_app(app, render_lazily=True)
+    app.data_model.finalize()
+    assert "Person" in app.data_model.data_model
+    assert "Person" in app.extensions["cereal"].class_from_name
+
+
+def test_concurrent_finalize_waits_for_the_rendering(app):
+    app = _exposed_method_model_app(app, render_lazily=True)
+    data_model = app.data_model
+    render_models = data_model.render_models
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_render_models(apis, app):
+        started.set()
+        release.wait(5)
+        render_models(apis, app)
+
+    data_model.render_models = slow_render_models
+    seen = []
+
+    def finalize():
+        data_model.finalize()
+        seen.append("Person" in data_model.data_model)
+
+    first = threading.Thread(target=finalize)
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=finalize)
+    second.start()
+    second.join(0.2)
+    assert second.is_alive()
+
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert seen == [True, True]
+
+
+def test_it_classifies_static_and_class_methods(app):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        first_name = db.Column(db.Unicode)
+
+        @hybrid_property
+        def name(self):
+            return self.first_name
+
+        @staticmethod
+        def static_method(value):
+            return value
+
+        @classmethod
+        def class_method(cls):
+            return cls
+
+    db.create_all()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Person, methods=["GET"])
+    data_model = DataModel(manager)
+    manager.create_api(data_model, methods=["GET"])
+
+    person = data_model.data_model["Person"]
+    assert person["attributes"]["name"] == "hybrid"
+    assert person["methods"]["static_method"]["args"] == ["value"]
+    assert "class_method" not in person["methods"]
+
+
+def test_renders_are_loaded_from_the_cache_file(
+    app, client_maker, tmp_path, monkeypatch
+):
+    cache_file = tmp_path / "datamodel.json"
+    first_app = _exposed_method_model_app(app, cache_file=str(cache_file))
+    # written once the models are rendered, without serving the datamodel
+    assert cache_file.exists()
+    client = client_maker(first_app)
+    expected = client.get("http://app/api/flask-restless-datamodel").json()
+
+    def render(*args, **kwargs):
+        raise AssertionError("the cached render should have been used")
+
+    monkeypatch.setattr(DataModelRenderer, "render", render)
+    second_app = flask.Flask(__name__)
+    second_app.config.update(first_app.config)
+    with second_app.app_context():
+        _exposed_method_model_app(second_app, cache_file=str(cache_file))
+        client = client_maker(second_app)
+        res = client.get("http://app/api/flask-restless-datamodel").json()
+        assert res == expected
+
+        # serializers and rpc endpoints are registered from the cached render
+        sr = second_app.extensions["cereal"]
+        url = "http://app/api/method/person/1/age_in_x_years_y_months"
+        body = to_method_params({"args": [10], "kwargs": {}}, sr)
+        res = sr.loads(client.post(url, json=body).json()["payload"])
+        assert res == date(2028, 1, 1)
+
+
+def test_polymorphic_info_is_not_cached(app, client_maker, tmp_path):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        discriminator = db.Column(db.Unicode)
+        __mapper_args__ = {"polymorphic_on": discriminator}
+
+    class Engineer(Person):
+        __mapper_args__ = {"polymorphic_identity": "engineer"}
+        id = db.Column(db.Integer, db.ForeignKey("person.id"), primary_key=True)
+
+    db.create_all()
+
+    cache_file = tmp_path / "datamodel.json"
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Person, methods=["GET"])
+    manager.create_api(Engineer, methods=["GET"])
+    data_model = DataModel(manager, cache_file=str(cache_file))
+    manager.create_api(data_model, methods=["GET"])
+    client_maker(app).get("http://app/api/flask-restless-datamodel")
+
+    renders = json.loads(cache_file.read_text())["models"]
+    assert "polymorphic" not in renders["Engineer"]["render"]
+    assert "polymorphic" not in renders["Person"]["render"]
+    assert data_model.data_model["Engineer"]["polymorphic"]["parent"] == "Person"
+
+    # the mapper args are part of the fingerprint
+    Engineer.__mapper_args__ = {"polymorphic_identity": "eng"}
+    data_model.rerender_model(Engineer)
+    data_model.finalize()
+    cached = json.loads(cache_file.read_text())["models"]["Engineer"]
+    assert cached["fingerprint"] != renders["Engineer"]["fingerprint"]
+    assert data_model.data_model["Engineer"]["polymorphic"]["identity"] == "eng"
+
+
+def test_fingerprint_follows_wrapped_signatures(app, tmp_path):
+    db = SQLAlchemy(app)
+
+    def logged(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return fn(*args, **kwargs)
+
+        return wrapper
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+        @logged
+        def foo(self, a):
+            return a
+
+    db.create_all()
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Person, methods=["GET"])
+    data_model = DataModel(
+        manager, include_model_functions=True, cache_file=str(tmp_path / "dm.json")
+    )
+    manager.create_api(data_model, methods=["GET"])
+    assert data_model.data_model["Person"]["methods"]["foo"]["args"] == ["a"]
+
+    @logged
+    def foo(self, a, b, c):
+        return a
+
+    # the wrapper's own code didn't change, its signature did
+    Person.foo = foo
+    data_model.rerender_model(Person)
+    assert data_model.data_model["Person"]["methods"]["foo"]["args"] == ["a", "b", "c"]
+
+
+def test_call_exposed_method_in_batch(exposed_method_model_app, client_maker):
+    app = exposed_method_model_app
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    url = "http://app/api/method/person/age_in_x_years_y_months"
+    calls = [[1, [10], {}], [1, [], {"y_offset": 1, "m_offset": 2}], [42, [1], {}]]
+    res = client.post(url, json={"payload": sr.dumps(calls)}).json()
+    assert sr.loads(res["payload"]) == [
+        {"result": date(2028, 1, 1)},
+        {"result": date(2019, 3, 1)},
+        {"error": "NotFound: no instance with id 42"},
+    ]
+    assert res["committed"] is False
+
+    url = "http://app/api/method/person/raise_an_error"
+    res = client.post(url, json={"payload": sr.dumps([[1, [], {}]])}).json()
+    assert sr.loads(res["payload"]) == [{"error": "Exception: Something happened"}]
+
+
+def test_malformed_batch_calls_are_rejected(exposed_method_model_app, client_maker):
+    app = exposed_method_model_app
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    url = "http://app/api/method/person/age_in_x_years_y_months"
+    res = client.post(url, json={"payload": sr.dumps({"calls": []})})
+    assert res.status_code == 400
+
+    res = client.post(url, json={"payload": sr.dumps([[1, [10]], [1, [10], {}]])})
+    assert sr.loads(res.json()["payload"]) == [
+        {"error": "TypeError: expected an [instid, args, kwargs] call"},
+        {"result": date(2028, 1, 1)},
+    ]
+
+
+def test_it_can_get_properties_in_bulk(exposed_method_model_app, client_maker):
+    app = exposed_method_model_app
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    url = "http://app/api/property/person?instid=1&instid=42&name=id_to_text"
+    res = sr.loads(client.get(url).json()["payload"])
+    assert res == {"1": {"id_to_text": "one"}}
+
+    url = "http://app/api/property/person?instid=1"
+    res = sr.loads(client.get(url).json()["payload"])
+    assert res == {"1": {"id_to_text": "one", "settable_property": "Jim Darkmagic"}}
+
+    url = "http://app/api/property/person?instid=1&name=secret_key"
+    res = client.get(url)
+    assert res.status_code == 400
+    assert res.json() == {"message": "Unknown properties: secret_key"}
+
+
+def test_model_references_are_loaded_in_one_query(
+    exposed_method_model_app, client_maker
+):
+    app = exposed_method_model_app
+    db = app.extensions["sqlalchemy"].db
+    for i in range(5):
+        db.session.add(app.Person(name=f"Person {i}"))
+    db.session.commit()
+
+    client = client_maker(app)
+    client_cereal = Cereal()
+
+    class Person:
+        def __init__(self, id):
+            self.id = id
+
+    client_cereal.register_class("Person", Person, lambda x: {"id": x.id}, None)
+
+    url = "http://app/api/method/person/what_does_this_func_even_do"
+    calls = [[1, [], {"person": Person(i)}] for i in range(2, 7)]
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", count_statement)
+    res = client.post(url, json={"payload": client_cereal.dumps(calls)}).json()
+    sqlalchemy.event.remove(db.engine, "before_cursor_execute", count_statement)
+
+    sr = app.extensions["cereal"]
+    names = [item["result"].name for item in sr.loads(res["payload"])]
+    assert names == [f"Person {i}" for i in range(5)]
+    # one query for the instances the method is called on, one for the people
+    # passed as argument
+    assert len([s for s in statements if s.startswith("SELECT")]) == 2
+
+
+def test_instances_are_loaded_once_per_request(exposed_method_model_app, client_maker):
+    app = exposed_method_model_app
+    db = app.extensions["sqlalchemy"].db
+    client = client_maker(app)
+    client_cereal = Cereal()
+
+    class Person:
+        id = 1
+
+    client_cereal.register_class("Person", Person, lambda x: {"id": x.id}, None)
+
+    url = "http://app/api/method/person/1/what_does_this_func_even_do"
+    body = to_method_params({"args": [], "kwargs": {"person": Person()}}, client_cereal)
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", count_statement)
+    res = client.post(url, json=body)
+    sqlalchemy.event.remove(db.engine, "before_cursor_execute", count_statement)
+
+    assert res.status_code == 200
+    assert len([s for s in statements if s.startswith("SELECT")]) == 1
+
+
+def test_identity_cache_is_cleared_on_commit(exposed_method_model_app):
+    app = exposed_method_model_app
+    db = app.extensions["sqlalchemy"].db
+    with app.test_request_context():
+        get_instance(app.Person, 1)
+        assert (app.Person, "1") in identity_cache()
+        db.session.commit()
+        assert (app.Person, "1") not in identity_cache()
+
+
+def test_rpc_calls_through_a_single_dispatcher(app, client_maker):
+    app = _exposed_method_model_app(app, rpc_dispatcher=True)
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    rpc_rules = [
+        rule.rule
+        for rule in app.url_map.iter_rules()
+        if rule.rule.startswith(("/api/method", "/api/property"))
+    ]
+    assert len(rpc_rules) == 4
+
+    url = "http://app/api/method/person/1/age_in_x_years_y_months"
+    body = to_method_params({"args": [10], "kwargs": {}}, sr)
+    res = sr.loads(client.post(url, json=body).json()["payload"])
+    assert res == date(2028, 1, 1)
+
+    url = "http://app/api/property/person/1/id_to_text"
+    assert sr.loads(client.get(url).json()["payload"]) == "one"
+    url = "http://app/api/property/person?instid=1&name=id_to_text"
+    assert sr.loads(client.get(url).json()["payload"]) == {"1": {"id_to_text": "one"}}
+
+    url = "http://app/api/method/person/1/reset_secret_key"
+    assert client.post(url, json=body).status_code == 404
+    url = "http://app/api/method/person/1/age_in_x_years_y_months"
+    assert client.get(url).status_code == 405
+
+
+def test_datamodel_can_be_fetched_partially(app, client_maker):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        discriminator = db.Column(db.Unicode)
+        __mapper_args__ = {"polymorphic_on": discriminator}
+
+    class Engineer(Person):
+        __mapper_args__ = {"polymorphic_identity": "engineer"}
+        id = db.Column(db.Integer, db.ForeignKey("person.id"), primary_key=True)
+
+    class Computer(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        owner_id = db.Column(db.Integer, db.ForeignKey("engineer.id"))
+        owner = db.relationship("Engineer")
+
+    class Building(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    # related to a registered model, but without an api of its own
+    class Desk(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        computer_id = db.Column(db.Integer, db.ForeignKey("computer.id"))
+        computer = db.relationship("Computer", backref="desks")
+
+    db.create_all()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    for model in (Person, Engineer, Computer, Building):
+        manager.create_api(model, methods=["GET"])
+    data_model = DataModel(manager)
+    manager.create_api(data_model, methods=["GET"])
+
+    client = client_maker(app)
+    url = "http://app/api/flask-restless-datamodel"
+    res = client.get(url, params={"models": "Computer"}).json()
+    assert set(res) == {"FlaskRestlessDatamodel", "Computer"}
+
+    res = client.get(url, params={"collections": "computer", "closure": "1"}).json()
+    assert set(res) == {"FlaskRestlessDatamodel", "Computer", "Engineer", "Person"}
+    assert res["Person"] == data_model.data_model["Person"]
+    assert "Desk" in {r["foreign_model"] for r in res["Computer"]["relations"].values()}
+
+    res = client.get(url, params={"models": "Nope"})
+    assert res.status_code == 400
+    assert res.json() == {"message": "Unknown models: Nope"}
+
+
+def test_datamodel_can_be_streamed(app, client_maker):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    class Computer(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    db.create_all()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Person, methods=["GET"])
+    manager.create_api(Computer, methods=["GET"])
+    data_model = DataModel(manager, stream_datamodel=True)
+    manager.create_api(data_model, methods=["GET"])
+
+    client = client_maker(app)
+    url = "http://app/api/flask-restless-datamodel"
+    res = client.get(url)
+    assert res.json() == data_model.data_model
+    assert res.content == data_model.serialized_data_model.encodings["identity"]
+
+    res = client.get(url, params={"models": "Person"}, headers={"If-None-Match": "x"})
+    assert set(res.json()) == {"FlaskRestlessDatamodel", "Person"}
+
+    res = client.get(url, headers={"If-None-Match": res.headers["ETag"]})
+    assert res.status_code == 200
+    res = client.get(url, headers={"If-None-Match": res.headers["ETag"]})
+    assert res.status_code == 304
+
+
+@pytest.mark.parametrize("json_backend", ["json", "orjson"])
+def test_json_backends(app, client_maker, json_backend):
+    if json_backend == "orjson":
+        pytest.importorskip("orjson")
+    app = _exposed_method_model_app(app, json_backend=json_backend)
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    res = client.get("http://app/api/flask-restless-datamodel").json()
+    assert res["Person"] == app.data_model.data_model["Person"]
+
+    url = "http://app/api/method/person/age_in_x_years_y_months"
+    res = client.post(url, json={"payload": sr.dumps([[1, [10], {}]])}).json()
+    assert sr.loads(res["payload"]) == [{"result": date(2028, 1, 1)}]
+    assert res["committed"] is False
+
+
+def test_rpc_payloads_can_be_sent_as_raw_cereal(exposed_method_model_app, client_maker):
+    app = exposed_method_model_app
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+    headers = {"Content-Type": CEREAL_MIMETYPE, "Accept": CEREAL_MIMETYPE}
+
+    url = "http://app/api/method/person/age_in_x_years_y_months"
+    body = bytes.fromhex(sr.dumps([[1, [10], {}]]))
+    res = client.post(url, data=body, headers=headers)
+    assert res.headers["Content-Type"] == CEREAL_MIMETYPE
+    assert res.headers["X-Datamodel-Committed"] == "false"
+    assert sr.loads(res.content.hex()) == [{"result": date(2028, 1, 1)}]
+
+    # clients that don't ask for raw cereal keep getting the JSON envelope
+    url = "http://app/api/method/person/1/age_in_x_years_y_months"
+    body = bytes.fromhex(sr.dumps({"args": [10], "kwargs": {}}))
+    res = client.post(url, data=body, headers={"Content-Type": CEREAL_MIMETYPE})
+    assert sr.loads(res.json()["payload"]) == date(2028, 1, 1)
+
+
+def test_collection_results_can_be_paginated(exposed_method_model_app, client_maker):
+    app = exposed_method_model_app
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+    with app.app_context():
+        app.Person.query.session.add(app.Person(name="Second"))
+        app.Person.query.session.commit()
+
+    url = "http://app/api/method/person/1/count_to?page_size=2"
+    body = to_method_params({"args": [5], "kwargs": {}}, sr)
+    res = client.post(url, json=body).json()
+    assert sr.loads(res["payload"]) == [1, 2]
+    assert res["next_cursor"] == 2
+    res = client.post(url + "&cursor=4", json=body).json()
+    assert sr.loads(res["payload"]) == [5]
+    assert res["next_cursor"] is None
+
+    url = "http://app/api/method/person/1/everyone?page_size=1&cursor=1"
+    body = to_method_params({"args": [], "kwargs": {}}, sr)
+    res = client.post(url, json=body).json()
+    assert [p.name for p in sr.loads(res["payload"])] == ["Second"]
+
+    url = "http://app/api/method/person/1/everyone?page_size=0"
+    res = client.post(url, json=body)
+    assert res.status_code == 400
+
+
+def test_collection_results_can_be_streamed(exposed_method_model_app, client_maker):
+    app = exposed_method_model_app
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    url = "http://app/api/method/person/1/count_to?page_size=2"
+    body = to_method_params({"args": [5], "kwargs": {}}, sr)
+    res = client.post(url, json=body, headers={"Accept": "application/x-ndjson"})
+    assert res.headers["Content-Type"] == "application/x-ndjson"
+    lines = res.content.splitlines()
+    assert [sr.loads(json.loads(line)["payload"]) for line in lines] == [
+        [1, 2],
+        [3, 4],
+        [5],
+    ]
+
+
+def test_methods_can_run_as_jobs(app, client_maker):
+    db = SQLAlchemy(app)
+    release = threading.Event()
+
+    class Report(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.Unicode)
+
+        @run_as_job
+        def rename(self, name):
+            release.wait(5)
+            self.name = name
+            return name.upper()
+
+    db.create_all()
+    db.session.add(Report(name="draft"))
+    db.session.commit()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Report, methods=["GET"])
+    data_model = DataModel(
+        manager, include_model_functions=True, commit_on_method_return=True
+    )
+    manager.create_api(data_model, methods=["GET"])
+    data_model.register_rpc_blueprint()
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    url = "http://app/api/method/report/1/rename"
+    res = client.post(url, json=to_method_params({"args": ["final"], "kwargs": {}}, sr))
+    assert res.status_code == 202
+    job_id = res.json()["job_id"]
+    assert res.headers["Location"] == f"/api/job/{job_id}"
+
+    res = client.get(f"http://app/api/job/{job_id}")
+    assert res.status_code == 202
+    assert res.json() == {"status": "pending"}
+
+    release.set()
+    data_model.jobs.get(job_id).result(5)
+    res = client.get(f"http://app/api/job/{job_id}")
+    assert sr.loads(res.json()["payload"]) == "FINAL"
+    db.session.expire_all()
+    assert Report.query.get(1).name == "final"
+
+    # the outcome is only served once
+    assert client.get(f"http://app/api/job/{job_id}").status_code == 404
+
+    # jobs can't be run in a batch
+    url = "http://app/api/method/report/rename"
+    assert client.post(url, json=sr.dumps([[1, ["x"], {}]])).status_code == 404
+
+
+def test_finished_jobs_make_room_for_new_ones():
+    queue = JobQueue(max_workers=1, max_jobs=2)
+    release = threading.Event()
+    first = queue.submit(lambda: 1)
+    queue.get(first).result(5)
+    second = queue.submit(release.wait, 5)
+    # the queue is full, the unfetched outcome of the first job is dropped
+    third = queue.submit(release.wait, 5)
+    assert third is not None
+    assert queue.get(first) is None
+    # only unfinished jobs are left, so new jobs are refused
+    assert queue.submit(lambda: 4) is None
+    release.set()
+    queue.get(second).result(5)
+    assert queue.submit(lambda: 4) is not None
+
+
+def test_results_of_marked_methods_and_properties_are_cached(app, client_maker):
+    db = SQLAlchemy(app)
+    calls = []
+
+    class Report(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.Unicode)
+
+        @property
+        @cache_result
+        def title(self):
+            calls.append("title")
+            return self.name.title()
+
+        @title.setter
+        def title(self, value):
+            self.name = value
+
+        @cache_result(ttl=0)
+        def shout(self, suffix):
+            calls.append("shout")
+            return self.name.upper() + suffix
+
+    db.create_all()
+    db.session.add(Report(name="draft"))
+    db.session.commit()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Report, methods=["GET"])
+    data_model = DataModel(manager, include_model_functions=True, result_cache_size=1)
+    manager.create_api(data_model, methods=["GET"])
+    data_model.register_rpc_blueprint()
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    url = "http://app/api/property/report/1/title"
+    assert sr.loads(client.get(url).json()["payload"]) == "Draft"
+    assert sr.loads(client.get(url).json()["payload"]) == "Draft"
+    assert calls == ["title"]
+
+    client.post(url, json=sr.dumps("final"))
+    assert sr.loads(client.get(url).json()["payload"]) == "Final"
+    assert calls == ["title", "title"]
+
+    # expires straight away, and evicts the cached title from the full cache
+    url = "http://app/api/method/report/1/shout"
+    body = to_method_params({"args": ["!"], "kwargs": {}}, sr)
+    assert sr.loads(client.post(url, json=body).json()["payload"]) == "FINAL!"
+    assert sr.loads(client.post(url, json=body).json()["payload"]) == "FINAL!"
+    assert calls == ["title", "title", "shout", "shout"]
+
+    assert data_model.result_cache.stats() == {
+        "size": 1,
+        "hits": 1,
+        "misses": 4,
+        "evictions": 1,
+        "expirations": 1,
+        "invalidations": 1,
+    }
+
+
+def test_malformed_calls_are_rejected_before_loading_anything(
+    exposed_method_model_app, client_maker
+):
+    app = exposed_method_model_app
+    db = app.extensions["sqlalchemy"].db
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    sqlalchemy.event.listen(db.engine, "before_cursor_execute", count_statement)
+    url = "http://app/api/method/person/1/age_in_x_years_y_months"
+    body = to_method_params({"args": [], "kwargs": {"unknown": 1}}, sr)
+    res = client.post(url, json=body)
+    assert res.status_code == 400
+    assert res.json()["message"].startswith("TypeError: missing a required argument")
+
+    url = "http://app/api/method/person/age_in_x_years_y_months"
+    calls = [[1, [1, 2], {"m_offset": 3}], [1, [10], {}]]
+    res = client.post(url, json={"payload": sr.dumps(calls)}).json()
+    sqlalchemy.event.remove(db.engine, "before_cursor_execute", count_statement)
+
+    assert sr.loads(res["payload"]) == [
+        {"error": "TypeError: multiple values for argument 'm_offset'"},
+        {"result": date(2028, 1, 1)},
+    ]
+    # only the instance of the valid batch call was loaded
+    assert len([s for s in statements if s.startswith("SELECT")]) == 1
+
+
+def test_read_only_calls_dont_end_the_transaction(
+    exposed_method_model_app_with_commit, client_maker
+):
+    app = exposed_method_model_app_with_commit
+    db = app.extensions["sqlalchemy"].db
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+    ended = []
+
+    def end(conn):
+        ended.append(conn)
+
+    sqlalchemy.event.listen(db.engine, "commit", end)
+    sqlalchemy.event.listen(db.engine, "rollback", end)
+    url = "http://app/api/method/person/1/age_in_x_years_y_months"
+    body = to_method_params({"args": [10], "kwargs": {}}, sr)
+    assert client.post(url, json=body).status_code == 200
+    assert ended == []
+
+    url = "http://app/api/property/person/1/settable_property"
+    client.post(url, json=sr.dumps("Jim Darkmagic"))
+    assert ended == []
+    client.post(url, json=sr.dumps("Jim Lightmagic"))
+    assert len(ended) == 1
+    sqlalchemy.event.remove(db.engine, "commit", end)
+    sqlalchemy.event.remove(db.engine, "rollback", end)
+
+
+def test_properties_can_be_set_in_one_transaction(
+    exposed_method_model_app, client_maker
+):
+    app = exposed_method_model_app
+    db = app.extensions["sqlalchemy"].db
+    db.session.add(app.Person(name="Second"))
+    db.session.commit()
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    url = "http://app/api/property/person"
+    body = {1: {"settable_property": "One"}, 2: {"settable_property": "Two"}}
+    assert client.post(url, json=sr.dumps(body)).status_code == 200
+    db.session.expire_all()
+    assert [p.name for p in app.Person.query.order_by(app.Person.id)] == [
+        "One",
+        "Two",
+    ]
+
+    body = {1: {"settable_property": "Uno"}, 42: {"settable_property": "?"}}
+    assert client.post(url, json=sr.dumps(body)).status_code == 404
+    body = {1: {"id_to_text": "uno"}}
+    res = client.post(url, json=sr.dumps(body))
+    assert res.status_code == 400
+    assert res.json()["message"] == "Unknown or read-only properties: id_to_text"
+    assert client.post(url, json=sr.dumps({1: 5})).status_code == 400
+    headers = {"Content-Type": "application/json"}
+    res = client.post(url, data="{nope", headers=headers)
+    assert res.status_code == 400
+    assert res.json()["message"] == "Malformed JSON body"
+    assert client.post(url, json=[]).status_code == 400
+
+    url = "http://app/api/method/person/1/age_in_x_years_y_months"
+    for body in ([], "x", {"args": [10]}, {"payload": 5}):
+        assert client.post(url, json=body).status_code == 400
+    db.session.expire_all()
+    assert app.Person.query.get(1).name == "One"
+
+
+def test_mapper_lookups_are_cached_without_triggering_descriptors(app):
+    db = SQLAlchemy(app)
+    evaluated = []
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        first_name = db.Column(db.Unicode)
+
+        @hybrid_property
+        def name(self):
+            return self.first_name
+
+        @name.expression
+        def name(cls):
+            evaluated.append(cls)
+            return cls.first_name
+
+    configure_mappers()
+    assert primary_key_names(Person) == ["id"]
+    assert get_relations(Person) == []
+
+    class Computer(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        owner_id = db.Column(db.Integer, db.ForeignKey("person.id"))
+        owner = db.relationship("Person", backref="computers")
+        owner_name = association_proxy("owner", "first_name")
+
+    # configuring the new mapper adds a backref to Person, and clears the cache
+    configure_mappers()
+    assert get_relations(Person) == ["computers"]
+    assert get_relations(Computer) == ["owner"]
+    assert primary_key_name(Person) == "id"
+    assert evaluated == []
+
+
+def test_is_like_list_is_primed_on_registration(app, client_maker):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.Unicode)
+
+    class Computer(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        owner_id = db.Column(db.Integer, db.ForeignKey("person.id"))
+        owner = db.relationship("Person", backref="computers")
+        owner_name = association_proxy("owner", "name")
+
+    db.create_all()
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Person, methods=["GET"])
+    data_model = DataModel(manager)
+    manager.create_api(data_model, methods=["GET"])
+
+    assert patches._like_list[(Person, "computers")] is True
+    assert (Computer, "owner") not in patches._like_list
+    assert patches.is_like_list(Computer(), "owner") is False
+    assert patches._like_list[(Computer, "owner")] is False
+
+    db.session.add(Computer(owner=Person(name="Jim")))
+    db.session.commit()
+    res = client_maker(app).get("http://app/api/person").json()
+    assert res["objects"][0]["computers"][0]["owner_id"] == 1
+
+
+def test_has_and_any_filters_are_compiled_once(app):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.Unicode)
+
+    class Computer(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        owner_id = db.Column(db.Integer, db.ForeignKey("person.id"))
+        owner = db.relationship("Person", backref="computers")
+
+    db.create_all()
+    db.session.add_all([Computer(owner=Person(name="Jim")), Computer()])
+    db.session.commit()
+
+    def owned_by(name):
+        argument = {"name": "name", "op": "eq", "val": name}
+        return Computer.owner.has(patches._sub_operator(Computer.owner, argument, ""))
+
+    assert [c.id for c in Computer.query.filter(owned_by("Jim"))] == [1]
+    compiled = dict(patches._sub_operations)
+    assert Computer.query.filter(owned_by("Bob")).all() == []
+    assert patches._sub_operations == compiled
+
+    # nested filters go through the any operator of flask-restless
+    argument = {
+        "name": "computers",
+        "op": "any",
+        "val": {"name": "id", "op": "eq", "val": 1},
+    }
+    expression = patches._sub_operator(Computer.owner, argument, "")
+    assert [c.id for c in Computer.query.filter(Computer.owner.has(expression))] == [1]
+
+
+def test_importing_doesnt_read_package_metadata():
+    code = "import sys, flask_restless_datamodel; print('pbr.version' in sys.modules)"
+    res = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    assert res.stdout.strip() == "False"
+
+    patches.apply_patches()
+    assert flask_restless.search._sub_operator is patches._sub_operator
+    assert flask_restless.views.get_relations is patches.get_relations
+
+
+def test_building_a_datamodel_doesnt_read_package_metadata():
+    code = """
+import sys, flask, flask_restless
+from flask_restless_datamodel import DataModel
+from flask_sqlalchemy import SQLAlchemy
+
+app = flask.Flask(__name__)
+app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///"
+app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+with app.app_context():
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Person, methods=["GET"])
+    manager.create_api(DataModel(manager), methods=["GET"])
+    print("pbr.version" in sys.modules)
+    res = app.test_client().get("/api/flask-restless-datamodel")
+    print(res.json["FlaskRestlessDatamodel"]["server_version"] is not None)
+"""
+    res = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    # only read once the datamodel is served
+    assert res.stdout.split() == ["False", "True"]
+    assert flask_restless.views.get_relations is patches.get_relations
+
+
+def test_a_single_model_can_be_rendered_again(app, client_maker):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        discriminator = db.Column(db.Unicode)
+        __mapper_args__ = {"polymorphic_on": discriminator}
+
+    class Engineer(Person):
+        __mapper_args__ = {"polymorphic_identity": "engineer"}
+        id = db.Column(db.Integer, db.ForeignKey("person.id"), primary_key=True)
+
+    class Computer(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+
+    db.create_all()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    for model in (Person, Engineer, Computer):
+        manager.create_api(model, methods=["GET"])
+    data_model = DataModel(manager)
+    manager.create_api(data_model, methods=["GET"])
+
+    client = client_maker(app)
+    url = "http://app/api/flask-restless-datamodel"
+    client.get(url)
+    assert set(data_model._fragments) == {META_KEY, "Person", "Engineer", "Computer"}
+
+    Engineer.__mapper_args__ = {"polymorphic_identity": "eng"}
+    data_model.rerender_model(Engineer)
+    assert set(data_model._fragments) == {META_KEY, "Computer"}
+
+    res = client.get(url).json()
+    assert res["Person"]["polymorphic"]["identities"] == {"eng": "Engineer"}
+    assert res["Engineer"]["polymorphic"]["identity"] == "eng"
+
+
+@pytest.mark.parametrize("render_lazily", [False, True])
+def test_rendering_again_doesnt_duplicate_rpc_rules(app, client_maker, render_lazily):
+    # rendered before and after the rpc blueprint got registered, respectively
+    app = _exposed_method_model_app(app, render_lazily=render_lazily)
+    data_model = app.data_model
+    data_model.finalize()
+    data_model.rerender_model(app.Person)
+    data_model.finalize()
+
+    rule = "/api/method/person/<instid>/age_in_x_years_y_months"
+    assert [r.rule for r in app.url_map.iter_rules()].count(rule) == 1
+
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+    body = to_method_params({"args": [10], "kwargs": {}}, sr)
+    url = "http://app/api/method/person/1/age_in_x_years_y_months"
+    assert sr.loads(client.post(url, json=body).json()["payload"]) == date(2028, 1, 1)
+
+
+@pytest.mark.parametrize(
+    "options",
+    [{}, {"render_lazily": True}, {"rpc_dispatcher": True}],
+    ids=["rules", "lazy-rules", "dispatcher"],
+)
+def test_rendering_again_removes_rules_no_longer_exposed(app, client_maker, options):
+    app = _exposed_method_model_app(app, **options)
+    data_model = app.data_model
+    data_model.finalize()
+    # the model no longer has these properties and methods
+    removed = {
+        name: app.Person.__dict__[name]
+        for name in ("id_to_text", "settable_property", "count_to")
+    }
+    for name in removed:
+        delattr(app.Person, name)
+    url_rules = list(app.url_map.iter_rules())
+    data_model.rerender_model(app.Person)
+    data_model.finalize()
+    # only the table of the rules changed, not the url map
+    assert list(app.url_map.iter_rules()) == url_rules
+
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+    body = to_method_params({"args": [3], "kwargs": {}}, sr)
+    assert (
+        client.post("http://app/api/method/person/1/count_to", json=body).status_code
+        == 404
+    )
+    assert (
+        client.post(
+            "http://app/api/method/person/count_to", json=sr.dumps([])
+        ).status_code
+        == 404
+    )
+    assert client.get("http://app/api/property/person/1/id_to_text").status_code == 404
+    assert client.get("http://app/api/property/person?instid=1").status_code == 404
+
+    body = to_method_params({"args": [10], "kwargs": {}}, sr)
+    url = "http://app/api/method/person/1/age_in_x_years_y_months"
+    assert sr.loads(client.post(url, json=body).json()["payload"]) == date(2028, 1, 1)
+
+    # exposing them again revives the rules
+    for name, attribute in removed.items():
+        setattr(app.Person, name, attribute)
+    data_model.rerender_model(app.Person)
+    data_model.finalize()
+    assert client.get("http://app/api/property/person/1/id_to_text").status_code == 200
+
+
+def test_bulk_writes_are_committed(app, client_maker):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.Unicode)
+
+        def bulk_rename(self, name):
+            Person.query.filter(Person.id == self.id).update({"name": name})
+
+        def raw_rename(self, name):
+            db.session.execute(
+                sqlalchemy.text("UPDATE person SET name = :name WHERE id = :id"),
+                {"name": name, "id": self.id},
+            )
+
+    db.create_all()
+    db.session.add(Person(name="a"))
+    db.session.commit()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Person, methods=["GET"])
+    data_model = DataModel(
+        manager, include_model_functions=True, commit_on_method_return=True
+    )
+    manager.create_api(data_model, methods=["GET"])
+    data_model.register_rpc_blueprint()
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    for method in ("bulk_rename", "raw_rename"):
+        url = f"http://app/api/method/person/1/{method}"
+        body = to_method_params({"args": [method], "kwargs": {}}, sr)
+        assert client.post(url, json=body).status_code == 200
+        db.session.rollback()
+        assert Person.query.get(1).name == method
+
+
+def test_views_are_only_caught_on_the_capturing_thread():
+    class View:
+        def dispatch_request(self):
+            return "original"
+
+    original = View.dispatch_request
+    getaway_car = []
+    View.dispatch_request = catch_model_view(original, getaway_car)
+    view = View()
+
+    # a request served on another thread meanwhile isn't caught
+    results = []
+    thread = threading.Thread(target=lambda: results.append(view.dispatch_request()))
+    thread.start()
+    thread.join()
+    assert results == ["original"]
+    assert getaway_car == []
+
+    assert view.dispatch_request() == {}
+    assert getaway_car == [view]
+    assert View.dispatch_request is original
+
+
+@pytest.mark.parametrize("render_lazily", [False, True])
+def test_rpc_rules_answer_options_requests(app, client_maker, render_lazily):
+    app = _exposed_method_model_app(app, render_lazily=render_lazily)
+    client = client_maker(app)
+    # rendering lazily adds the rules on this first request
+    client.get("http://app/api/flask-restless-datamodel")
+    url = "http://app/api/method/person/1/age_in_x_years_y_months"
+    res = client.options(url)
+    assert res.status_code == 200
+    assert {"OPTIONS", "POST"}.issubset(res.headers["Allow"].split(", "))
+    # the methods of the rule are only checked once it is dispatched
+    assert client.get(url).status_code == 405
+
+
+def test_batch_calls_report_a_failed_commit(app, client_maker):
+    db = SQLAlchemy(app)
+
+    class Person(db.Model):
+        id = db.Column(db.Integer, primary_key=True)
+        name = db.Column(db.Unicode, unique=True)
+
+        def clone(self):
+            # only violates the unique constraint once committed
+            db.session.add(Person(name=self.name))
+
+    db.create_all()
+    db.session.add(Person(name="a"))
+    db.session.commit()
+
+    manager = flask_restless.APIManager(app, flask_sqlalchemy_db=db)
+    manager.create_api(Person, methods=["GET"])
+    data_model = DataModel(
+        manager, include_model_functions=True, commit_on_method_return=True
+    )
+    manager.create_api(data_model, methods=["GET"])
+    data_model.register_rpc_blueprint()
+    client = client_maker(app)
+    sr = app.extensions["cereal"]
+
+    url = "http://app/api/method/person/clone"
+    res = client.post(url, json={"payload": sr.dumps([[1, [], {}]])}).json()
+    assert sr.loads(res["payload"]) == [{"result": None}]
+    assert res["committed"] is False
+    # the failed transaction was rolled back, the session can be used again
+    assert Person.query.count() == 1